@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+End to end benchmark: Agent with synthetic conf.d and virtual hosts checks
+items and sends values to a local fake trapper (bench/trapper.py).
+
+Every host gets the same --items items, spread over --scripts scripts;
+equal items of all hosts are checked once, as in production. Reports
+values received per second against the expected rate, latency of value
+batches sent, CPU usage and memory of the agent.
+
+usage: bench/agent.py [--hosts N] [--items N] [--interval SECONDS] [--protocol 1.4|1.8|2.0] ...
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import argparse
+import threading
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..'))
+sys.path.insert(0, bench_dir)
+from trapper import Trapper, make_checks
+
+check_module = '''
+def vmain(combinations):
+    return [len(args[0]) for args in combinations]
+'''
+
+def make_conf_dir(path, scripts, kind):
+    os.makedirs(os.path.join(path, 'conf.d'))
+    os.makedirs(os.path.join(path, 'bin'))
+    open(os.path.join(path, 'bin', 'bench_check.py'), 'w').write(check_module)
+    commands = {
+        'module': 'bench_check.py $1',
+        'shell': 'echo $1',
+    }
+    conf = open(os.path.join(path, 'conf.d', 'bench.conf'), 'w')
+    for i in range(scripts):
+        conf.write('UserParameter=bench.{0}[*],{1}\n'.format(i, commands[kind]))
+    conf.close()
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def get_rss():
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def get_cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+class TimedSend(object):
+    '''wraps Sender.send_items, recording latency of every batch'''
+    def __init__(self, send_items):
+        self.send_items = send_items
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def __call__(self, values):
+        start = time.time()
+        try:
+            return self.send_items(values)
+        finally:
+            with self.lock:
+                self.latencies.append(time.time() - start)
+
+    def reset(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='zabbix-agent-ng end to end benchmark')
+    parser.add_argument('--hosts', type=int, default=100, help='number of virtual hosts')
+    parser.add_argument('--items', type=int, default=100, help='items of every host')
+    parser.add_argument('--scripts', type=int, default=10, help='number of scripts items are spread over')
+    parser.add_argument('--kind', default='module', help='scripts kind: module or shell')
+    parser.add_argument('--interval', type=int, default=10, help='items interval (seconds)')
+    parser.add_argument('--protocol', default='1.8', help='1.4, 1.8 or 2.0')
+    parser.add_argument('--duration', type=float, default=30, help='measurement time (seconds)')
+    parser.add_argument('--server-delay', type=float, default=0, help='trapper response delay (seconds)')
+    parser.add_argument('--agent-args', default='', help='more agent options, e.g. "--workers=16 --compress=1"')
+    args = parser.parse_args()
+
+    trapper = Trapper(make_checks(args.scripts, args.items, args.interval), delay=args.server_delay)
+    trapper.start()
+    conf_dir = tempfile.mkdtemp(prefix='zabbix-agent-ng-bench-')
+    try:
+        make_conf_dir(conf_dir, args.scripts, args.kind)
+        sys.path.insert(0, os.path.join(conf_dir, 'bin'))
+        sys.argv = [sys.argv[0], '--server=127.0.0.1', '--port={0}'.format(trapper.port),
+                    '--zabbix-conf-dir={0}'.format(conf_dir), '--protocol={0}'.format(args.protocol),
+                    '--hosts={0}'.format(','.join('bench{0}'.format(i) for i in range(args.hosts - 1))),
+                    '--spool-dir=', '--manifest-cache=', '--listen-port=0', '--processes=1'] + args.agent_args.split()
+        import zabbix_agent_ng
+        zabbix_agent_ng.Script.bin_dir = os.path.join(conf_dir, 'bin')
+        rss_before = get_rss()
+        agent = zabbix_agent_ng.Agent()
+        timed_send = TimedSend(agent.sender.send_items)
+        agent.sender.send_items = timed_send
+        agent.send_queue.start()
+        agent.start_hosts()
+        agent.loop.start()
+
+        # first interval: hosts get item lists and first checks are spread
+        time.sleep(args.interval + 1)
+        timed_send.reset()
+        values, cpu, start = trapper.values, get_cpu_time(), time.time()
+        time.sleep(args.duration)
+        values, cpu, wall = trapper.values - values, get_cpu_time() - cpu, time.time() - start
+        latencies = timed_send.reset()
+
+        total_items = args.hosts * args.items
+        print('{0} hosts x {1} items = {2} items, every {3} s, protocol {4}, {5} scripts'.format(
+            args.hosts, args.items, total_items, args.interval, args.protocol, args.kind))
+        print('values: {0:.1f}/s (expected {1:.1f}/s)'.format(values / wall, float(total_items) / args.interval))
+        print('send batches: {0}, latency p50 {1:.1f} ms, p90 {2:.1f} ms, p99 {3:.1f} ms, max {4:.1f} ms'.format(
+            len(latencies), *[percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)]))
+        print('cpu: {0:.1f}%'.format(cpu / wall * 100))
+        print('rss: {0:.1f} MB ({1:.1f} MB for agent), max rss {2:.1f} MB'.format(
+            get_rss() / 1048576.0, (get_rss() - rss_before) / 1048576.0,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        shutil.rmtree(conf_dir, True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks of zbx_* collectors' vmain against generated /proc
+fixtures (zbx_procfs.root points to them), at configurable scale.
+
+Each collector is timed for a batch of --combinations argument tuples,
+with /proc snapshots read on every call (ttl 0) and shared between
+calls (ttl 1 hour).
+
+usage: bench/collectors.py [--cpus N] [--ifaces N] [--processes N] [--combinations N] [--repeat N]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import zbx_procfs
+
+def write(root, name, data):
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').write(data)
+
+def make_fixtures(root, cpus, ifaces, processes):
+    stat = ['cpu  {0}'.format(' '.join(str(n * cpus) for n in range(1000, 1010)))]
+    stat += ['cpu{0} {1}'.format(i, ' '.join(str(n + i) for n in range(1000, 1010))) for i in range(cpus)]
+    stat += ['intr 1000 0 0', 'ctxt 10000', 'btime 1500000000', 'processes 1000', 'procs_running 1', 'procs_blocked 0']
+    write(root, 'stat', '\n'.join(stat) + '\n')
+
+    dev = ['Inter-|   Receive                                                |  Transmit',
+           ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed']
+    dev += ['{0:>6}: {1}'.format('eth{0}'.format(i), ' '.join(str(i * 1000 + n) for n in range(16))) for i in range(ifaces)]
+    write(root, 'net/dev', '\n'.join(dev) + '\n')
+
+    snmp = ['Ip: Forwarding DefaultTTL InReceives InHdrErrors InDelivers OutRequests', 'Ip: 2 64 5950 0 5950 5775',
+            'Tcp: RtoAlgorithm RtoMin RtoMax MaxConn ActiveOpens PassiveOpens AttemptFails EstabResets CurrEstab InSegs OutSegs RetransSegs',
+            'Tcp: 1 200 120000 -1 57 55 0 2 2 5942 5767 10',
+            'Udp: InDatagrams NoPorts InErrors OutDatagrams', 'Udp: 8 0 0 8']
+    write(root, 'net/snmp', '\n'.join(snmp) + '\n')
+    names = ['Counter{0}'.format(i) for i in range(100)]
+    write(root, 'net/netstat', 'TcpExt: {0}\nTcpExt: {1}\n'.format(' '.join(names), ' '.join(map(str, range(100)))))
+
+    write(root, 'meminfo', ''.join('{0}: {1} kB\n'.format(name, 1024 * (i + 1)) for i, name in
+                                   enumerate(['MemTotal', 'MemFree', 'Buffers', 'Cached', 'SwapTotal', 'SwapFree'])))
+    write(root, 'loadavg', '0.50 0.40 0.30 1/100 12345\n')
+    write(root, 'net/stat/rt_cache', 'entries  in_hit\n00000004 00000000\n')
+    slabinfo = ['slabinfo - version: 2.1', '# name            <active_objs> <num_objs> <objsize> <objperslab> <pagesperslab> : tunables <limit> <batchcount> <sharedfactor> : slabdata <active_slabs> <num_slabs> <sharedavail>']
+    slabinfo += ['slab{0:<14} {1:6} {1:6} {2:6}   26    1 : tunables    0    0    0 : slabdata     79     79      0'.format(i, i * 10, 64 + i) for i in range(200)]
+    write(root, 'slabinfo', '\n'.join(slabinfo) + '\n')
+
+    for pid in range(1, processes + 1):
+        name = 'proc{0}'.format(pid % 50)
+        fields = ['S'] + ['0'] * 19 + [str(pid * 4096 * 1000), str(pid * 100)] + ['0'] * 20
+        write(root, '{0}/stat'.format(pid), '{0} ({1}) {2}\n'.format(pid, name, ' '.join(fields)))
+        write(root, '{0}/cmdline'.format(pid), '/usr/bin/{0}\0--option\0'.format(name))
+        write(root, '{0}/smaps_rollup'.format(pid), 'Rss: 400 kB\nPss: 300 kB\nPrivate_Clean: 100 kB\nPrivate_Dirty: 50 kB\n')
+
+def collector_combinations(cpus, ifaces, count):
+    '''argument tuples of each collector, as items would pass them'''
+    counters = ['user', 'nice', 'system', 'idle', 'wait', 'irq', 'softirq', 'busy']
+    return [
+        ('zbx_cpuutil', [(str(i % cpus), counters[i % len(counters)], (i % 2 or counters[i % len(counters)] == 'busy') and 'pct' or '') for i in range(count)]),
+        ('zbx_netif', [('eth{0}'.format(i % ifaces), i % 2 and 'rx' or 'tx', 'bytes', i % 3 and 'rate' or '') for i in range(count)]),
+        ('zbx_netstat', [('Tcp.ActiveOpens - prev.Tcp.ActiveOpens + TcpExt.Counter{0}'.format(i % 100),) for i in range(count)]),
+        ('zbx_vm', [(['free', 'total', 'pfree', 'cached', 'buffers'][i % 5],) for i in range(count)]),
+        ('zbx_procmem', [(['rss', 'vms', 'pss', 'count'][i % 4], 'proc{0}'.format(i % 50), '', 'sum', '') for i in range(count)]),
+        ('zbx_slabinfo', [('slab{0}'.format(i % 200), str(2 + i % 3)) for i in range(count)]),
+        ('zbx_df', [('/', ['total', 'free', 'avail', 'ifree'][i % 4]) for i in range(count)]),
+    ]
+
+def bench(module, combinations, repeat):
+    module.vmain(combinations)
+    start = time.time()
+    for i in range(repeat):
+        module.vmain(combinations)
+    return (time.time() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description='zbx_* collectors benchmark')
+    parser.add_argument('--cpus', type=int, default=64)
+    parser.add_argument('--ifaces', type=int, default=32)
+    parser.add_argument('--processes', type=int, default=500)
+    parser.add_argument('--combinations', type=int, default=100, help='argument tuples passed to every vmain call')
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='zabbix-agent-ng-proc-')
+    try:
+        make_fixtures(root, args.cpus, args.ifaces, args.processes)
+        zbx_procfs.root = root
+        print('{0} cpus, {1} interfaces, {2} processes, {3} combinations per call'.format(
+            args.cpus, args.ifaces, args.processes, args.combinations))
+        print('{0:<14}{1:>16}{2:>16}'.format('collector', 'read, ms/call', 'shared, ms/call'))
+        for name, combinations in collector_combinations(args.cpus, args.ifaces, args.combinations):
+            module = __import__(name)
+            times = []
+            for ttl in (0, 3600):
+                zbx_procfs.ttl = ttl
+                times.append(bench(module, combinations, args.repeat) * 1000)
+            print('{0:<14}{1:>16.3f}{2:>16.3f}'.format(name, *times))
+    finally:
+        shutil.rmtree(root, True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+'''
+Memory per Item and cost of active checks diffing, as done by
+Host.update_active_checks, for a given number of items.
+
+usage: bench/items.py [count ...]
+'''
+
+import os
+import sys
+import gc
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zabbix_agent_ng import Script, Item
+
+def get_rss():
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def make_items(script, count, hosts, changed=0):
+    items = []
+    for i in range(count):
+        host = 'vhost{0}.example.com'.format(i % hosts)
+        n = i / hosts + (i < changed and count or 0)
+        items.append(Item(host, 'bench.key[{0},$hostname]'.format(n), 60, script, [str(n), '$hostname']))
+    return items
+
+def bench(count, hosts=200):
+    script = Script('bench.key[*],echo $1 $2', None, None, None)
+    gc.collect()
+    rss = get_rss()
+    items = make_items(script, count, hosts)
+    bytes_per_item = float(get_rss() - rss) / count
+    current = set(items)
+    # 1% of items changed since the previous update
+    retrieved_items = make_items(script, count, hosts, count / 100)
+    start = time.time()
+    retrieved = set(retrieved_items)
+    added_items = retrieved - current
+    removed_items = current - retrieved
+    diff_time = time.time() - start
+    assert len(added_items) == len(removed_items) == count / 100
+    print('{0:>8} items: {1:7.1f} bytes per item, diff {2:8.2f} ms'.format(count, bytes_per_item, diff_time * 1000))
+
+if __name__ == '__main__':
+    for count in map(int, sys.argv[1:]) or [10000, 100000]:
+        bench(count)
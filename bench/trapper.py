@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+'''
+Local stand-in for zabbix server trapper, for benchmarks.
+
+Answers active checks requests with the same item list for every host and
+accepts values over protocol 1.4 (base64 <req> documents) and over ZBXD
+framed JSON of protocols 1.8 and 2.0, compressed or not. Received values
+are only counted; a response delay may be set to play a slow server.
+
+usage: bench/trapper.py [--port PORT] [--items N] [--interval SECONDS]
+'''
+
+import socket
+import struct
+import threading
+import json
+import zlib
+import time
+import argparse
+
+class Trapper(object):
+    def __init__(self, checks, address=('127.0.0.1', 0), delay=0):
+        '''checks is a list of (key, delay) returned for every host'''
+        self.checks = checks
+        self.delay = delay
+        self.values = 0
+        self.requests = 0
+        self.last_value_time = None
+        self.lock = threading.Lock()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.accept, name='trapper')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def accept(self):
+        while True:
+            conn, address = self.sock.accept()
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def recv(self, conn, size):
+        chunks = []
+        while size > 0:
+            chunk = conn.recv(min(size, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def serve(self, conn):
+        try:
+            while True:
+                header = self.recv(conn, 5)
+                if not header:
+                    break
+                if header[:4] != 'ZBXD':
+                    # protocol 1.4 value: one <req> document per connection
+                    self.handle_14(conn, header + conn.recv(65536))
+                    break
+                flags = ord(header[4])
+                if flags & 0x02:
+                    data_len, _ = struct.unpack('<II', self.recv(conn, 8))
+                    data = zlib.decompress(self.recv(conn, data_len))
+                else:
+                    data_len = struct.unpack('<Q', self.recv(conn, 8))[0]
+                    data = self.recv(conn, data_len)
+                if data.startswith('ZBX_GET_ACTIVE_CHECKS'):
+                    # protocol 1.4 active checks, connection is closed after reply
+                    self.reply(conn, ''.join('{0}:{1}:0\n'.format(key, delay) for key, delay in self.checks) + 'ZBX_EOF\n', frame=False)
+                    break
+                self.reply(conn, json.dumps(self.handle_json(json.loads(data))), compress=flags & 0x02)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def handle_14(self, conn, data):
+        self.count(1)
+        self.reply(conn, 'OK', frame=False)
+
+    def handle_json(self, request):
+        if request[u'request'] == u'active checks':
+            return {'response': 'success', 'data': [{'key': key, 'delay': delay, 'lastlogsize': 0} for key, delay in self.checks]}
+        self.count(len(request[u'data']))
+        return {'response': 'success', 'info': 'processed: {0}; failed: 0'.format(len(request[u'data']))}
+
+    def count(self, values):
+        with self.lock:
+            self.values += values
+            self.requests += 1
+            self.last_value_time = time.time()
+
+    def reply(self, conn, data, frame=True, compress=False):
+        if self.delay:
+            time.sleep(self.delay)
+        if compress:
+            payload = zlib.compress(data)
+            data = struct.pack('<4sBII', 'ZBXD', 0x03, len(payload), len(data)) + payload
+        elif frame:
+            data = struct.pack('<4sBQ', 'ZBXD', 0x01, len(data)) + data
+        conn.sendall(data)
+
+def make_checks(scripts, items, interval):
+    '''items spread over scripts, keys are bench.<script>[<n>]'''
+    return [('bench.{0}[{1}]'.format(i % scripts, i), interval) for i in range(items)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fake zabbix trapper')
+    parser.add_argument('--port', type=int, default=10051)
+    parser.add_argument('--scripts', type=int, default=10)
+    parser.add_argument('--items', type=int, default=100, help='items of every host')
+    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0, help='response delay (seconds)')
+    args = parser.parse_args()
+    trapper = Trapper(make_checks(args.scripts, args.items, args.interval), ('0.0.0.0', args.port), args.delay)
+    trapper.start()
+    last = 0
+    while True:
+        time.sleep(1)
+        print('{0} values/s, {1} requests'.format(trapper.values - last, trapper.requests))
+        last = trapper.values
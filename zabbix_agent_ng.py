@@ -20,8 +20,490 @@ import daemon.pidlockfile
 import json
 import itertools
 import threading
+import heapq
+import Queue
+import select
+import errno
+import resource
+import fcntl
+import ctypes
+import ctypes.util
+import zlib
+import shlex
+import bisect
+import uuid
+import array
+import math
+import traceback
+import cStringIO
 from setproctitle import setproctitle
-from datetime import datetime, timedelta
+
+def get_monotonic_clock():
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        logging.getLogger('zabbix-agent-ng').warning('clock_gettime is not available, using wall clock for scheduling')
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = get_monotonic_clock()
+
+def select_ready(readers, writers, timeout):
+    '''
+    (readers, writers) of given descriptors or objects with fileno() ready for reading or writing,
+    or closed, waited for timeout seconds. Uses poll, so descriptors above FD_SETSIZE work;
+    retried when interrupted by a signal (SIGUSR1 stats dump).
+    '''
+    objects = {}
+    for fds, events in ((readers, select.POLLIN), (writers, select.POLLOUT)):
+        for obj in fds:
+            fd = obj
+            if not isinstance(fd, (int, long)):
+                fd = fd.fileno()
+            objects[fd] = (obj, objects.get(fd, (obj, 0))[1] | events)
+    poller = select.poll()
+    for fd, (obj, events) in objects.iteritems():
+        poller.register(fd, events)
+    while True:
+        try:
+            ready = poller.poll(timeout * 1000)
+            break
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+    readable, writable = [], []
+    for fd, event in ready:
+        obj, events = objects[fd]
+        # errors and hang-ups are reported as ready, so that reading gets EOF and writing gets EPIPE
+        if events & select.POLLIN and event & ~select.POLLOUT:
+            readable.append(obj)
+        if events & select.POLLOUT and event & ~select.POLLIN:
+            writable.append(obj)
+    return readable, writable
+
+def select_readable(fds, timeout):
+    return select_ready(fds, (), timeout)[0]
+
+class Timer(object):
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class WorkerPool(object):
+    def __init__(self, size, queue_size=0):
+        self.logger = logging.getLogger('WorkerPool')
+        self.jobs = Queue.Queue(queue_size)
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work_loop, name='worker-{0}'.format(i))
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        map(lambda t: t.start(), self.threads)
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def work_loop(self):
+        while True:
+            func, args = self.jobs.get()
+            try:
+                func(*args)
+            except Exception, e:
+                self.logger.exception(e)
+
+class Histogram(object):
+    '''
+    Log-bucketed histogram of durations (seconds), in fixed memory: bucket bounds
+    grow by 2^(1/4), so percentiles are within 19% of the real values.
+    Percentiles and max are of the last complete window, count and sum are since start.
+    '''
+    buckets_per_octave = 4
+    min_value = 0.000001
+    size = 4 * 40
+
+    def __init__(self):
+        self.current = array.array('L', [0]) * self.size
+        self.previous = array.array('L', [0]) * self.size
+        self.current_max = self.max = 0.0
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        if value <= self.min_value:
+            bucket = 0
+        else:
+            bucket = min(self.size - 1, int(math.log(value / self.min_value, 2) * self.buckets_per_octave))
+        self.current[bucket] += 1
+        self.current_max = max(self.current_max, value)
+        self.count += 1
+        self.sum += value
+
+    def rotate(self):
+        self.previous, self.current = self.current, array.array('L', [0]) * self.size
+        self.max, self.current_max = self.current_max, 0.0
+
+    def percentile(self, p):
+        total = sum(self.previous)
+        if not total:
+            return 0.0
+        rank = max(1, int(math.ceil(total * p / 100.0)))
+        for bucket, count in enumerate(self.previous):
+            rank -= count
+            if rank <= 0:
+                return min(self.max, self.min_value * 2 ** ((bucket + 1.0) / self.buckets_per_octave))
+
+    def get(self, stat):
+        if stat == 'count':
+            return self.count
+        elif stat == 'sum':
+            return self.sum
+        elif stat == 'avg':
+            return self.count and self.sum / self.count or 0.0
+        elif stat == 'max':
+            return self.max
+        elif stat[:1] == 'p':
+            return self.percentile(float(stat[1:]))
+        raise ValueError('invalid stat {0}: must be one of count, sum, avg, max or p<percent>'.format(stat))
+
+class Stats(object):
+    '''
+    Counters, gauges and latency histograms of the agent itself, exposed
+    as agent.stats[<metric>,<stat>] items and dumped to log on SIGUSR1.
+    '''
+    def __init__(self):
+        self.logger = logging.getLogger('Stats')
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def rotate(self):
+        with self.lock:
+            for histogram in self.histograms.itervalues():
+                histogram.rotate()
+
+    def get(self, metric, stat=''):
+        if metric in self.gauges:
+            return self.gauges[metric]()
+        with self.lock:
+            if metric in self.histograms:
+                return self.histograms[metric].get(stat or 'count')
+            return self.counters.get(metric, 0)
+
+    def vmain(self, combinations):
+        results = []
+        for args in combinations:
+            try:
+                results.append(self.get(*args[:2]))
+            except Exception, e:
+                self.logger.warning('failed to get {0}: {1}'.format(args, e))
+                results.append('ZBX_NOTSUPPORTED')
+        return results
+
+    def dump(self):
+        for name in sorted(self.counters):
+            self.logger.info('{0}: {1}'.format(name, self.get(name)))
+        for name in sorted(self.gauges):
+            self.logger.info('{0}: {1}'.format(name, self.get(name)))
+        for name in sorted(self.histograms):
+            self.logger.info('{0}: {1}'.format(name, ', '.join('{0} {1:.6g}'.format(stat, self.get(name, stat))
+                                                               for stat in ('count', 'avg', 'p50', 'p90', 'p99', 'max'))))
+
+stats = Stats()
+
+class CheckProfiler(object):
+    '''
+    Samples stacks of checks running longer than threshold seconds; when such
+    a check finishes, it is logged with its most frequent stack.
+    '''
+    sample_interval = 0.1
+    stack_depth = 8
+
+    def __init__(self):
+        self.logger = logging.getLogger('CheckProfiler')
+        self.threshold = 0
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def start(self, loop, threshold):
+        self.loop = loop
+        self.threshold = threshold
+        self.loop.call_later(self.sample_interval, self.sample)
+
+    def enter(self, script):
+        if self.threshold:
+            with self.lock:
+                self.running[threading.current_thread().ident] = (script, monotonic(), {})
+
+    def leave(self, elapsed):
+        if not self.threshold:
+            return
+        with self.lock:
+            entry = self.running.pop(threading.current_thread().ident, None)
+            if entry is None or elapsed < self.threshold:
+                return
+            script, start, samples = entry
+            samples = dict(samples)
+        stats.incr('slow_checks')
+        if samples:
+            stack, count = max(samples.iteritems(), key=lambda s: s[1])
+            self.logger.warning('{0} took {1:.3f} seconds, {2} of {3} samples in:\n{4}'.format(script, elapsed, count, sum(samples.values()), stack))
+        else:
+            self.logger.warning('{0} took {1:.3f} seconds'.format(script, elapsed))
+
+    def sample(self):
+        self.loop.call_later(self.sample_interval, self.sample)
+        now = monotonic()
+        with self.lock:
+            slow = [(ident, samples) for ident, (script, start, samples) in self.running.iteritems() if now - start >= self.threshold]
+        if not slow:
+            return
+        frames = sys._current_frames()
+        stacks = [(samples, ''.join(traceback.format_stack(frames[ident])[-self.stack_depth:]))
+                  for ident, samples in slow if ident in frames]
+        # samples of a check are read by leave on its own thread
+        with self.lock:
+            for samples, stack in stacks:
+                samples[stack] = samples.get(stack, 0) + 1
+
+profiler = CheckProfiler()
+
+class Loop(object):
+    '''
+    Single scheduling thread for all hosts and scripts.
+    Timers are run on the loop thread and must not block;
+    blocking work (collectors, network i/o) is handed to a bounded worker pool.
+    '''
+    def __init__(self, workers):
+        self.logger = logging.getLogger('Loop')
+        self.timers = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.pool = WorkerPool(workers)
+        self.thread = threading.Thread(target=self.run, name='loop')
+        self.thread.daemon = True
+
+    def start(self):
+        self.pool.start()
+        self.thread.start()
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        with self.condition:
+            heapq.heappush(self.timers, (deadline, next(self.sequence), timer))
+            if self.timers[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(monotonic(), callback, *args)
+
+    def run_in_executor(self, func, *args):
+        self.pool.submit(func, *args)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = monotonic()
+                    if self.timers and self.timers[0][0] <= now:
+                        break
+                    self.condition.wait(self.timers and self.timers[0][0] - now or None)
+                timer = heapq.heappop(self.timers)[2]
+            if timer.cancelled:
+                continue
+            stats.record('lag', monotonic() - timer.deadline)
+            try:
+                timer.callback(*timer.args)
+            except Exception, e:
+                self.logger.exception(e)
+
+ZBXD_PROTOCOL = 0x01
+ZBXD_COMPRESSED = 0x02
+
+def zbxd_frame(data, compress=False):
+    if compress:
+        payload = zlib.compress(data)
+        return struct.pack('<4sBII', 'ZBXD', ZBXD_PROTOCOL | ZBXD_COMPRESSED, len(payload), len(data)) + payload
+    return struct.pack('<4sBQ', 'ZBXD', ZBXD_PROTOCOL, len(data)) + data
+
+def zbxd_unframe(frame):
+    if frame[:4] != 'ZBXD' or len(frame) < 13:
+        return frame
+    if ord(frame[4]) & ZBXD_COMPRESSED:
+        return zlib.decompress(frame[13:])
+    return frame[13:]
+
+delay_suffixes = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_delay(delay):
+    '''Parse item delay: number of seconds or time suffixed string of zabbix 3.4+ ("30s", "5m").
+    Flexible and scheduling intervals after ';' are ignored.'''
+    if isinstance(delay, (int, long, float)):
+        return float(delay)
+    delay = delay.split(';')[0].strip()
+    if delay and delay[-1] in delay_suffixes:
+        return float(delay[:-1]) * delay_suffixes[delay[-1]]
+    return float(delay)
+
+class Connection(object):
+    def __init__(self, address, connect_timeout, timeout):
+        self.sock = socket.create_connection(address, connect_timeout)
+        self.sock.settimeout(timeout)
+        self.last_used = time.time()
+        self.reusable = False
+
+    def is_stale(self):
+        # idle connection must not be readable: readability means EOF (half-closed by server) or garbage
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return True
+        return bool(readable)
+
+    def request(self, data):
+        self.reusable = False
+        self.sock.sendall(data)
+        header = self.recv(13)
+        if header[:4] == 'ZBXD' and len(header) == 13 and ord(header[4]) & ZBXD_PROTOCOL:
+            if ord(header[4]) & ZBXD_COMPRESSED:
+                # compressed frame: 4 bytes of payload length and 4 bytes of uncompressed length
+                data_len = struct.unpack('<I', header[5:9])[0]
+            else:
+                data_len = struct.unpack('<Q', header[5:13])[0]
+            response = self.recv(data_len)
+            if len(response) != data_len:
+                raise socket.error(errno.ECONNRESET, 'connection closed while reading response')
+            self.reusable = True
+            self.last_used = time.time()
+            return header + response
+        # not framed: server replies until EOF
+        chunks = [header]
+        while True:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def recv(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.sock.recv(min(size, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+class ConnectionPool(object):
+    '''
+    Keeps idle connections to zabbix server for reuse.
+    Connections closed by server are detected and dropped before use.
+    '''
+    def __init__(self, address, options):
+        self.logger = logging.getLogger('ConnectionPool')
+        self.address = address
+        self.connect_timeout = options.connect_timeout
+        self.timeout = options.timeout
+        self.max_idle = options.max_idle_connections
+        self.idle_timeout = options.idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if conn.last_used + self.idle_timeout > time.time() and not conn.is_stale():
+                return conn, True
+            conn.close()
+        return Connection(self.address, self.connect_timeout, self.timeout), False
+
+    def put(self, conn):
+        if conn.reusable:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(conn)
+                    return
+        conn.close()
+
+    def request(self, data):
+        conn, reused = self.get()
+        try:
+            response = conn.request(data)
+        except socket.error, e:
+            conn.close()
+            if not reused:
+                raise
+            # server may close idle connection right after staleness check
+            self.logger.debug('reused connection failed ({0}), retrying with new one'.format(e))
+            conn = Connection(self.address, self.connect_timeout, self.timeout)
+            try:
+                response = conn.request(data)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        self.put(conn)
+        return response
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        map(Connection.close, idle)
+
+class SendError(Exception):
+    def __init__(self, message, unsent):
+        Exception.__init__(self, message)
+        self.unsent = unsent
 
 class Sender(object):
     def __init__(self, options):
@@ -29,6 +511,8 @@ class Sender(object):
         self.logger.info('created Sender; options={0}'.format(options))
         self.server = options.server
         self.port = options.port
+        self.pool = ConnectionPool((self.server, self.port), options)
+        self.batch_size = options.send_batch_size
         if options.protocol == '1.4':
             self.get_active_checks = self._get_active_checks_14
             self.send_items = self._send_items_14
@@ -37,31 +521,48 @@ class Sender(object):
             self.get_active_checks = self._get_active_checks_18
             self.send_items = self._send_items_18
             self.send_req = self._send_req_18
+        elif options.protocol == '2.0':
+            self.get_active_checks = self._get_active_checks_20
+            self.send_items = self._send_items_20
+            self.send_req = self._send_req_20
         else:
-            raise InvalidArgument('protocol must be one of 1.4 or 1.8')
+            raise ValueError('protocol must be one of 1.4, 1.8 or 2.0')
         self.decoder = json.JSONDecoder()
         self.encoder = json.JSONEncoder()
+        self.max_request_size = options.max_request_size
+        self.compress = bool(options.compress)
+        # values are numbered within session so server can drop the ones it has already got
+        self.session = uuid.uuid4().hex
+        self.last_id = 0
+        # request buffer is reused by every batch; only SendQueue thread sends values
+        self.buffer = cStringIO.StringIO()
 
-    def _get_active_checks_14(selfi, host):
+    def _get_active_checks_14(self, host):
         items = []
-        for line in self.send_req('ZBX_GET_ACTIVE_CHECKS\n{0}\n'.format(host)).readlines():
-            if line[:-1] == 'ZBX_EOF':
+        for line in self.send_req('ZBX_GET_ACTIVE_CHECKS\n{0}\n'.format(host)).split('\n'):
+            if line == 'ZBX_EOF':
                 break
             key, delay = line.split(':')[:2]
-            self.logger.debug('received active check {0}'.format(line[:-1]))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('received active check {0}'.format(line))
             items.append((key, float(delay)))
         return items
 
-    def _send_items_14(self, items, values, _timestamp):
-        for item, value in zip(items, values):
-            self.logger.debug('updating item {0}={1}'.format(item.key, value))
-            host = base64.b64encode(item.host)
-            key = base64.b64encode(item.key)
+    def _send_items_14(self, values):
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for i, (host, key, value, _clock) in enumerate(values):
+            if debug:
+                self.logger.debug('updating item [{0}]{1}={2}'.format(host, key, value))
+            host = base64.b64encode(host)
+            key = base64.b64encode(key)
             data = base64.b64encode(str(value))
             request = '<req><host>{host}</host><key>{key}</key><data>{data}</data></req>'.format(**locals())
-            reply = self._do_request(request).read()
+            try:
+                reply = self._do_request(request)
+            except socket.error, e:
+                raise SendError(str(e), values[i:])
             if reply != 'OK':
-                raise RuntimeError(reply)
+                raise SendError(reply, values[i:])
 
     def _send_req_14(self, data):
         data_len = struct.pack('<Q', len(data))
@@ -70,28 +571,26 @@ class Sender(object):
         msg = '{header}{version}{data_len}{data}'.format(**locals())
         return self._do_request(msg)
 
-    ZABBIX_18_MAX_REQUEST = 20
-    def _send_items_18(self, items, values, timestamp):
-        item_value = zip(items, values)
-        for i, group in itertools.groupby(enumerate(item_value), key=lambda i: i[0]/self.ZABBIX_18_MAX_REQUEST):
+    def _send_items_18(self, values):
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for i in range(0, len(values), self.batch_size):
             inner_data = []
-            for i, (item, value) in group:
+            for host, key, value, clock in values[i:i+self.batch_size]:
                 if value is None:
-                    self.logger.warning('ignoring None value for item [{0}]{1}'.format(item.host, item.key))
+                    self.logger.warning('ignoring None value for item [{0}]{1}'.format(host, key))
                     continue
-                self.logger.debug('sending item [{2}]{0}={1}'.format(item.key, value, item.host))
-                inner_data.append({'host': item.host, 'key': item.key, 'value': value, 'clock': timestamp})
-            data = {'request': 'agent data', 'clock': timestamp, 'data': inner_data}
-            for i in range(5):
-                try:
-                    response = self.send_req(data)
-                    if response[u'response'] != u'success':
-                        raise RuntimeError(response)
-                    self.logger.debug('items successfully sent: {0}'.format(', '.join(['{0}.{1}'.format(item.host, item.key) for item in items])))
-                    break
-                except:
-                    self.logger.error('failed to send items', exc_info=True)
-                    self.logger.info('resending items: {0} try'.format(i+1))
+                if debug:
+                    self.logger.debug('sending item [{0}]{1}={2}'.format(host, key, value))
+                inner_data.append({'host': host, 'key': key, 'value': value, 'clock': int(clock)})
+            data = {'request': 'agent data', 'clock': int(time.time()), 'data': inner_data}
+            try:
+                response = self.send_req(data)
+            except (socket.error, ValueError), e:
+                raise SendError(str(e), values[i:])
+            if response[u'response'] != u'success':
+                raise SendError(str(response), values[i:])
+            if debug:
+                self.logger.debug('items successfully sent: {0}'.format(', '.join(['{0}.{1}'.format(d['host'], d['key']) for d in inner_data])))
 
     def _get_active_checks_18(self, host):
         response = self.send_req({'request': 'active checks', 'host': host})
@@ -103,45 +602,565 @@ class Sender(object):
         header = 'ZBXD\x01'
         request = self.encoder.encode(data)
         data_len = struct.pack('<Q', len(request))
-        self.logger.debug('sending request: {0}'.format(request))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('sending request: {0}'.format(request))
         msg = '{header}{data_len}{data}'.format(header=header, data_len=data_len, data=request)
-        response_data = self._do_request(msg).read()
-        self.logger.debug('received response: {0}'.format(response_data))
+        response_data = self._do_request(msg)
+        if response_data[:5] == 'ZBXD\x01':
+            response_data = response_data[13:]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('received response: {0}'.format(response_data))
         response = self.decoder.decode(response_data)
         return response
 
+    def _send_items_20(self, values):
+        i = 0
+        while i < len(values):
+            request, count, end = self._encode_values_20(values, i)
+            if count:
+                try:
+                    response = self._send_encoded_20(request)
+                except (socket.error, ValueError, zlib.error), e:
+                    raise SendError(str(e), values[i:])
+                if response.get(u'response') != u'success':
+                    raise SendError(str(response), values[i:])
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('{0} items sent: {1}'.format(count, response.get(u'info')))
+            i = end
+
+    def _encode_values_20(self, values, start):
+        """Encode values from start into agent data request not bigger than max_request_size.
+        Returns request, number of encoded values and index of the first value left."""
+        encode = json.encoder.encode_basestring_ascii
+        buf = self.buffer
+        buf.seek(0)
+        buf.truncate()
+        buf.write('{{"request":"agent data","session":"{0}","data":['.format(self.session))
+        now = time.time()
+        tail = '],"clock":{0},"ns":{1}}}'.format(int(now), int(now % 1 * 1000000000))
+        size = buf.tell() + len(tail)
+        count = 0
+        i = start
+        for i in xrange(start, len(values)):
+            host, key, value, clock = values[i]
+            if value is None:
+                self.logger.warning('ignoring None value for item [{0}]{1}'.format(host, key))
+                continue
+            if isinstance(value, float):
+                value = repr(value)
+            elif not isinstance(value, basestring):
+                value = str(value)
+            record = '{0}{{"host":{1},"key":{2},"value":{3},"id":{4},"clock":{5},"ns":{6}}}'.format(
+                count and ',' or '', encode(host), encode(key), encode(value),
+                self.last_id + 1, int(clock), int(clock % 1 * 1000000000))
+            if count and size + len(record) > self.max_request_size:
+                break
+            self.last_id += 1
+            buf.write(record)
+            size += len(record)
+            count += 1
+        else:
+            i = len(values)
+        buf.write(tail)
+        return buf.getvalue(), count, i
+
+    def _send_encoded_20(self, request):
+        msg = zbxd_frame(request, self.compress)
+        try:
+            response_data = self._do_request(msg)
+        except socket.error, e:
+            # server may have processed the request before connection broke;
+            # resend with the same session and ids lets it drop the duplicates
+            self.logger.warning('request failed, resending: {0}'.format(e))
+            response_data = self._do_request(msg)
+        response_data = zbxd_unframe(response_data)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('received response: {0}'.format(response_data))
+        return self.decoder.decode(response_data)
+
+    def _get_active_checks_20(self, host):
+        response = self.send_req({'request': 'active checks', 'host': host})
+        if response[u'response'] != u'success':
+            raise RuntimeError(response)
+        return [(i[u'key'], parse_delay(i[u'delay'])) for i in response.get(u'data', [])]
+
+    def _send_req_20(self, data):
+        request = self.encoder.encode(data)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('sending request: {0}'.format(request))
+        return self.decoder.decode(zbxd_unframe(self._do_request(zbxd_frame(request, self.compress))))
+
     def item_not_supported(self, key):
         self.update_item((key, 'ZBX_NOTSUPPORTED'))
 
     def _do_request(self, data):
-        sock = socket.socket()
-        sock.connect((self.server, self.port))
-        sock.send(data)
-        return sock.makefile()
+        start = monotonic()
+        try:
+            return self.pool.request(data)
+        except socket.error:
+            stats.incr('request_errors')
+            raise
+        finally:
+            stats.record('request', monotonic() - start)
+
+class Spool(object):
+    '''
+    Append-only spool of values not accepted by zabbix server.
+    Values are written to numbered segment files, one JSON record per line,
+    and read back from the oldest segment. Read position is kept in the
+    'offset' file, so values are not replayed twice after restart.
+    When the spool exceeds max_size, either the oldest segments are removed
+    (eviction = oldest) or new values are dropped (eviction = newest).
+    '''
+    def __init__(self, options):
+        self.logger = logging.getLogger('Spool')
+        self.directory = options.spool_dir
+        self.max_size = options.spool_max_size
+        self.segment_size = options.spool_segment_size
+        if options.spool_eviction not in ('oldest', 'newest'):
+            raise ValueError('spool eviction must be one of oldest or newest')
+        self.eviction = options.spool_eviction
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.segments = sorted(int(name[:-6]) for name in os.listdir(self.directory) if name.endswith('.spool'))
+        self.sizes = dict((n, os.path.getsize(self.segment_path(n))) for n in self.segments)
+        self.writer = None
+        self.read_offset = 0
+        try:
+            segment, offset = map(int, open(self.offset_path()).read().split())
+            if self.segments and segment == self.segments[0]:
+                self.read_offset = offset
+        except (IOError, ValueError):
+            pass
+        if self.segments:
+            self.logger.info('found {0} spooled bytes in {1} segments'.format(self.size(), len(self.segments)))
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, '{0:016d}.spool'.format(segment))
+
+    def offset_path(self):
+        return os.path.join(self.directory, 'offset')
+
+    def size(self):
+        return sum(self.sizes.itervalues()) - self.read_offset
+
+    def __nonzero__(self):
+        return self.size() > 0
+
+    def write(self, values):
+        data = ''.join(json.dumps(value) + '\n' for value in values)
+        with self.lock:
+            if self.size() + len(data) > self.max_size:
+                if self.eviction == 'newest':
+                    self.logger.error('spool is full, dropping {0} values'.format(len(values)))
+                    return
+                while len(self.segments) > 1 and self.size() + len(data) > self.max_size:
+                    self.logger.error('spool is full, dropping segment {0}'.format(self.segments[0]))
+                    self.remove_segment()
+            if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_size:
+                self.roll()
+            self.writer.write(data)
+            self.writer.flush()
+            self.sizes[self.segments[-1]] += len(data)
+
+    def roll(self):
+        if self.writer is not None:
+            self.writer.close()
+        segment = self.segments and self.segments[-1] + 1 or 0
+        self.writer = open(self.segment_path(segment), 'a')
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def remove_segment(self):
+        segment = self.segments.pop(0)
+        del self.sizes[segment]
+        self.read_offset = 0
+        if not self.segments:
+            self.writer.close()
+            self.writer = None
+        os.unlink(self.segment_path(segment))
+
+    def read(self, count):
+        '''returns up to count oldest values and position to pass to commit'''
+        with self.lock:
+            if not self:
+                return [], None
+            segment = self.segments[0]
+            f = open(self.segment_path(segment))
+            f.seek(self.read_offset)
+            values = []
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                try:
+                    host, key, value, clock = json.loads(line)
+                    values.append((host.encode('utf-8'), key.encode('utf-8'), value, clock))
+                except ValueError:
+                    self.logger.warning('skipping broken spool record {0!r}'.format(line))
+                if len(values) == count:
+                    break
+            position = (segment, f.tell())
+            f.close()
+            return values, position
+
+    def commit(self, position):
+        segment, offset = position
+        with self.lock:
+            if not self.segments or self.segments[0] != segment:
+                return
+            self.read_offset = offset
+            if offset >= self.sizes[segment]:
+                self.remove_segment()
+            with open(self.offset_path(), 'w') as f:
+                f.write('{0} {1}\n'.format(self.segments and self.segments[0] or 0, self.read_offset))
+
+class SendQueue(object):
+    '''
+    Collects values from all scripts and hosts and sends them in large batches.
+    A batch is sent when it reaches send_batch_size values or when the oldest
+    value waited for send_flush_interval seconds. When the queue is full,
+    checks block until the sender catches up.
+    Batches the server did not accept go to the spool and are replayed with
+    their original clock at spool_replay_rate values per second. After a
+    failure the server is not contacted again until the retry backoff expires.
+    '''
+    min_backoff = 1
+    max_backoff = 60
+
+    def __init__(self, sender, options):
+        self.logger = logging.getLogger('SendQueue')
+        self.sender = sender
+        self.batch_size = options.send_batch_size
+        self.flush_interval = options.send_flush_interval
+        self.queue = Queue.Queue(options.send_queue_size)
+        self.spool = None
+        if options.spool_dir:
+            self.spool = Spool(options)
+        self.replay_rate = options.spool_replay_rate
+        self.next_replay_time = 0
+        self.backoff = 0
+        self.retry_time = 0
+        self.thread = threading.Thread(target=self.run, name='sender')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, host, key, value, clock):
+        self.queue.put((host, key, value, clock))
+
+    def get_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                if batch:
+                    self.send(batch)
+                if self.spool is not None:
+                    self.replay()
+            except Exception, e:
+                self.logger.exception(e)
+
+    def send(self, batch):
+        if time.time() < self.retry_time:
+            self.spool_values(batch)
+            return
+        try:
+            self.sender.send_items(batch)
+        except SendError, e:
+            self.logger.error('failed to send {0} values: {1}'.format(len(e.unsent), e))
+            stats.incr('send_errors')
+            self.failed()
+            self.spool_values(e.unsent)
+        else:
+            stats.incr('sent', len(batch))
+            self.backoff = 0
+
+    def spool_values(self, values):
+        if self.spool is None:
+            self.logger.error('spool is disabled, dropping {0} values'.format(len(values)))
+            stats.incr('dropped', len(values))
+        else:
+            self.spool.write(values)
+            stats.incr('spooled', len(values))
+
+    def failed(self):
+        self.backoff = min(self.backoff * 2 or self.min_backoff, self.max_backoff)
+        self.retry_time = time.time() + self.backoff
+        self.logger.info('next try in {0} seconds'.format(self.backoff))
+
+    def replay(self):
+        now = time.time()
+        if now < max(self.retry_time, self.next_replay_time):
+            return
+        values, position = self.spool.read(self.batch_size)
+        if not values:
+            if position is not None:
+                self.spool.commit(position)
+            return
+        try:
+            self.sender.send_items(values)
+        except SendError, e:
+            self.logger.error('failed to replay {0} spooled values: {1}'.format(len(values), e))
+            stats.incr('send_errors')
+            self.failed()
+            return
+        stats.incr('replayed', len(values))
+        self.backoff = 0
+        self.spool.commit(position)
+        self.next_replay_time = now + float(len(values)) / self.replay_rate
+        self.logger.debug('replayed {0} spooled values'.format(len(values)))
+
+class ShellRunner(object):
+    '''
+    Runs shell commands concurrently, at most max_procs at a time for all scripts.
+    Each command runs in its own process group, which is killed on timeout.
+    Commands without shell metacharacters are executed directly, without sh -c,
+    unless they start with a variable assignment or a shell builtin or keyword.
+    '''
+    metacharacters = re.compile(r'[|&;<>()$`\\*?[\]#~{}\n]')
+    assignment = re.compile(r'[A-Za-z_][A-Za-z0-9_]*=')
+    # commands with no executable of the same name, or which have to change the shell itself
+    shell_words = frozenset(['!', '.', ':', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'do', 'done',
+                             'elif', 'else', 'esac', 'eval', 'exec', 'exit', 'export', 'fc', 'fg', 'fi', 'for', 'function',
+                             'getopts', 'hash', 'if', 'jobs', 'read', 'readonly', 'return', 'select', 'set', 'shift',
+                             'source', 'then', 'time', 'times', 'trap', 'type', 'ulimit', 'umask', 'unalias', 'unset',
+                             'until', 'wait', 'while'])
+
+    def __init__(self, options, cwd):
+        self.logger = logging.getLogger('ShellRunner')
+        self.timeout = options.shell_timeout
+        self.cwd = cwd
+        self.slots = threading.Semaphore(options.shell_max_procs)
+
+    def spawn(self, cmd):
+        args, shell = cmd, True
+        if not self.metacharacters.search(cmd):
+            words = shlex.split(cmd)
+            if words and words[0] not in self.shell_words and not self.assignment.match(words[0]):
+                args, shell = words, False
+        return subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE, shell=shell, close_fds=True, preexec_fn=os.setsid)
+
+    def kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run(self, commands):
+        results = ['ZBX_NOTSUPPORTED'] * len(commands)
+        waiting = list(enumerate(commands))
+        waiting.reverse()
+        running = {}
+        while waiting or running:
+            # block for a free slot only when nothing of ours is running, so runners can't starve each other
+            while waiting and self.slots.acquire(not running):
+                i, cmd = waiting.pop()
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('invoking shell: {0}'.format(cmd))
+                try:
+                    proc = self.spawn(cmd)
+                except (OSError, ValueError), e:
+                    self.logger.warning('failed to run {0}: {1}'.format(cmd, e))
+                    self.slots.release()
+                    continue
+                running[proc.stdout.fileno()] = (i, cmd, proc, [], monotonic() + self.timeout)
+            if not running:
+                continue
+            now = monotonic()
+            timeout = max(0, min(r[4] for r in running.itervalues()) - now)
+            for fd in select_readable(running.keys(), timeout):
+                i, cmd, proc, output, deadline = running[fd]
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    output.append(chunk)
+                    continue
+                del running[fd]
+                self.finish(proc)
+                if proc.returncode != 0:
+                    self.logger.warning('command {0} exited with code {1}'.format(cmd, proc.returncode))
+                else:
+                    results[i] = ''.join(output).split('\n', 1)[0]
+            now = monotonic()
+            for fd, (i, cmd, proc, output, deadline) in running.items():
+                if deadline <= now:
+                    self.logger.warning('command {0} timed out after {1} seconds, killing'.format(cmd, self.timeout))
+                    del running[fd]
+                    self.kill(proc)
+                    self.finish(proc)
+        return results
+
+    def finish(self, proc):
+        proc.stdout.close()
+        proc.wait()
+        self.slots.release()
+
+class CoprocessError(Exception):
+    pass
+
+class Coprocess(object):
+    r'''
+    Long-lived helper process checking batches of items, like vmain across a process boundary.
+    Helper is started with --worker argument appended to its command line.
+    Request and response are a line with the number of records followed by the records,
+    one per line: tab-separated arguments in request, values in response.
+    Backslash, tab and newline inside fields are escaped as \\, \t and \n.
+    An empty batch is a health check, sent after start and after idle periods.
+    Helper that crashes, hangs or breaks the protocol is killed and restarted.
+    '''
+    health_interval = 60
+    restart_delay = 10
+
+    def __init__(self, argv, cwd, timeout):
+        self.logger = logging.getLogger('coprocess {0}'.format(argv[0]))
+        self.argv = argv + ['--worker']
+        self.cwd = cwd
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.proc = None
+        self.buffer = ''
+        self.last_used = 0
+        self.restart_time = 0
+
+    @staticmethod
+    def escape(field):
+        return str(field).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    @staticmethod
+    def unescape(field):
+        return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), field)
+
+    def start(self):
+        self.logger.info('starting {0}'.format(' '.join(self.argv)))
+        self.proc = subprocess.Popen(self.argv, cwd=self.cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        # requests are written as the pipe takes them, reading responses meanwhile
+        fd = self.proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.buffer = ''
+        self.request([])
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+
+    def read(self):
+        chunk = os.read(self.proc.stdout.fileno(), 65536)
+        if not chunk:
+            raise CoprocessError('exited with code {0}'.format(self.proc.wait()))
+        self.buffer += chunk
+
+    def readline(self, deadline):
+        fd = self.proc.stdout.fileno()
+        while '\n' not in self.buffer:
+            timeout = deadline - monotonic()
+            if timeout <= 0 or not select_readable([fd], timeout):
+                raise CoprocessError('no response in {0} seconds'.format(self.timeout))
+            self.read()
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def write(self, data, deadline):
+        # helper may answer records before it reads the whole batch: both pipes are served,
+        # so a batch larger than the pipe buffers can't block both processes
+        stdin, stdout = self.proc.stdin.fileno(), self.proc.stdout.fileno()
+        offset = 0
+        while offset < len(data):
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                raise CoprocessError('request is not read in {0} seconds'.format(self.timeout))
+            readable, writable = select_ready([stdout], [stdin], timeout)
+            if readable:
+                self.read()
+            if writable:
+                try:
+                    offset += os.write(stdin, buffer(data, offset))
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+    def request(self, combinations):
+        deadline = monotonic() + self.timeout
+        lines = ['\t'.join(map(self.escape, args)) for args in combinations]
+        self.write('{0}\n{1}'.format(len(lines), ''.join(line + '\n' for line in lines)), deadline)
+        count = self.readline(deadline)
+        if count != str(len(lines)):
+            raise CoprocessError('invalid response header {0!r} for batch of {1}'.format(count, len(lines)))
+        results = [self.unescape(self.readline(deadline)) for args in combinations]
+        self.last_used = monotonic()
+        return results
+
+    def execute(self, combinations):
+        with self.lock:
+            try:
+                if self.proc is None:
+                    if monotonic() < self.restart_time:
+                        return ['ZBX_NOTSUPPORTED'] * len(combinations)
+                    self.start()
+                elif self.last_used + self.health_interval < monotonic():
+                    self.request([])
+                return self.request(combinations)
+            except (CoprocessError, IOError, OSError), e:
+                self.logger.error('worker failed: {0}; restarting in {1} seconds'.format(e, self.restart_delay))
+                self.stop()
+                self.restart_time = monotonic() + self.restart_delay
+                return ['ZBX_NOTSUPPORTED'] * len(combinations)
 
 class Script(object):
     bin_dir = '/etc/zabbix/bin'
-    def __init__(self, line, sender):
+    def __init__(self, line, send_queue, loop, shell_runner, worker=False):
         self.key, self.command = line.split(',', 1)
         self.logger = logging.getLogger(str(self))
         self.logger.debug('initializing with command {0}'.format(self.command))
         if self.key.endswith('[*]'):
             self.key = self.key[:-3]
         self.execute = self.execute_shell
-        if self.command.split()[0].endswith('.py'):
-            module = __import__(self.command.split()[0][:-3])
-            if hasattr(module, 'main') or hasattr(module, 'vmain'):
-                self.module = module
-                self.execute = self.execute_module
+        if worker:
+            # command is '<helper> [helper args] $1 $2 ...': the helper is started once,
+            # the rest is a template of argument tuples sent to it
+            argv = shlex.split(self.command)
+            template = list(itertools.takewhile(lambda a: not a.startswith('$'), argv))
+            self.coprocess = Coprocess(template, self.bin_dir, shell_runner.timeout)
+            self.args_map = list(self.parse_args_list(argv[len(template):]))
+            self.execute = self.execute_coprocess
+        elif self.command.split()[0].endswith('.py'):
+            # plugin is imported when the first item is bound to the script (or on first passive check)
+            self.module_name = self.command.split()[0][:-3]
+            self.module = None
+            self.execute = self.execute_lazy
             self.args_map = list(self.parse_args_format(self.command))
         self.items = set()
-        self.sender = sender
-        self.check_job = threading.Thread(target=self.check_loop)
-        self.check_job.daemon = True
+        self.send_queue = send_queue
+        self.loop = loop
+        self.shell_runner = shell_runner
+        self.pending = set()
         self.checking = False
         self.update_lock = threading.Lock()
-        self.stop_condition = threading.Condition()
-        self.interval = float('inf')
+        self.phase = zlib.crc32(self.key) % 1000 / 1000.0
+        self.stats_name = 'execute:' + self.key
 
     def __str__(self):
         return '<script {0}>'.format(self.key)
@@ -157,9 +1176,11 @@ class Script(object):
                 yield m
 
     def parse_args_format(self, command):
-        args_format = command.split()[1:]
+        return self.parse_args_list(command.split()[1:])
+
+    def parse_args_list(self, args_format):
         for symbol in args_format:
-            if symbol[0] == '$':
+            if symbol[:1] == '$':
                 if symbol[1] == '0':
                     yield self.key
                 else:
@@ -167,14 +1188,38 @@ class Script(object):
             else:
                 yield symbol
 
+    def load_module(self):
+        try:
+            module = __import__(self.module_name)
+        except Exception, e:
+            self.logger.error('can\'t import {0}: {1}'.format(self.module_name, e))
+            self.execute = self.execute_unsupported
+            return
+        if hasattr(module, 'main') or hasattr(module, 'vmain'):
+            self.module = module
+            self.execute = self.execute_module
+        else:
+            self.execute = self.execute_shell
+
+    def execute_lazy(self, args_combinations):
+        self.load_module()
+        return self.execute(args_combinations)
+
+    def execute_unsupported(self, args_combinations):
+        return ['ZBX_NOTSUPPORTED'] * len(args_combinations)
+
     def execute_module(self, args_combinations):
         args_combinations = map(lambda ac: list(self.map_arguments(ac)), args_combinations)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         if hasattr(self.module, 'vmain'):
-            self.logger.debug('calling {0}.vmain({1})'.format(self.module.__name__, args_combinations))
+            if debug:
+                self.logger.debug('calling {0}.vmain({1})'.format(self.module.__name__, args_combinations))
             results = self.module.vmain(args_combinations)
-            self.logger.debug('called {0}.vmain({1})'.format(self.module.__name__, args_combinations))
+            if debug:
+                self.logger.debug('called {0}.vmain({1})'.format(self.module.__name__, args_combinations))
         else:
-            self.logger.debug('calling {0}.main({1})'.format(self.module.__name__, args_combinations))
+            if debug:
+                self.logger.debug('calling {0}.main({1})'.format(self.module.__name__, args_combinations))
             results = []
             for args in args_combinations:
                 try:
@@ -186,118 +1231,373 @@ class Script(object):
                 results.append(result)
         return results
 
+    def execute_coprocess(self, args_combinations):
+        return self.coprocess.execute([list(self.map_arguments(args)) for args in args_combinations])
+
+    def format_command(self, args):
+        cmd = self.command
+        for i in range(10):
+            cmd = cmd.replace('${0}'.format(i+1), i < len(args) and args[i] or '')
+        return cmd
+
     def execute_shell(self, args_combinations):
-        result = []
-        for args in args_combinations:
-            cmd = self.command
-            for i in range(10):
-                cmd = cmd.replace('${0}'.format(i+1), i < len(args) and args[i] or '')
-            self.logger.debug('invoking shell: {0}'.format(cmd))
-            proc = subprocess.Popen(cmd, cwd=self.bin_dir, stdout=subprocess.PIPE, shell=True)
-            result.append(proc.communicate()[0].split('\n', 1)[0])
-            if proc.returncode != 0:
-                raise subprocess.CalledProcessError(proc.returncode, cmd)
-        return result
+        return self.shell_runner.run(map(self.format_command, args_combinations))
 
     def update(self, added_items, removed_items):
+        # import before taking the lock: loop thread takes it for every due item
+        if added_items and self.execute == self.execute_lazy:
+            self.load_module()
         with self.update_lock:
             for i in added_items + removed_items:
                 assert i.script == self, 'trying to bind item with unmatched script: {0} != {1}'.format(i.script, self)
-            if added_items or removed_items:
+            if (added_items or removed_items) and self.logger.isEnabledFor(logging.DEBUG):
                 self.logger.debug('added items: {0}; removed items: {1}'.format(', '.join(map(str, added_items)), ', '.join(map(str, removed_items))))
-            self.items |= set(added_items)
+            for item in removed_items:
+                item.unschedule()
+                self.pending.discard(item)
             self.items -= set(removed_items)
-            if self.items:
-                new_interval = min(self.items, key=lambda i: i.interval).interval
-                if self.interval != new_interval:
-                    self.logger.info('check interval changed from {0} to {1} seconds'.format(self.interval, new_interval))
-                    self.interval = new_interval
-
-            if self.items and not self.checking:
-                self.logger.debug('starting check loop')
-                self.checking = True
-                self.check_job.start()
-            elif not self.items and self.checking:
-                self.logger.debug('stopping check loop')
-                with self.stop_condition:
-                    self.checking = False
-                    self.stop_condition.notify()
-                self.check_job.join()
-
-    def check_loop(self):
-        with self.stop_condition:
-            while self.checking:
-                try:
-                    assert len(self.items) > 0
-                    self.check()
-                    self.stop_condition.wait(self.interval)
-                except Exception, e:
-                    self.logger.exception(e)
+            self.items |= set(added_items)
+            now = monotonic()
+            for item in added_items:
+                item.schedule(now, self.item_due)
+
+    def item_due(self, item):
+        '''called by loop when item deadline comes; items due together are checked in one batch'''
+        with self.update_lock:
+            if item.timer is None:
+                return
+            item.schedule(item.next_deadline(monotonic()), self.item_due)
+            if item in self.pending:
+                self.logger.warning('item {0} is still waiting for previous check'.format(item))
+                stats.incr('skipped')
+                return
+            if not self.pending and not self.checking:
+                self.loop.call_soon(self.dispatch)
+            self.pending.add(item)
+
+    def dispatch(self):
+        with self.update_lock:
+            if self.checking or not self.pending:
+                return
+            items = list(self.pending)
+            self.pending.clear()
+            self.checking = True
+        self.loop.run_in_executor(self.check_job, items)
 
-    def check(self):
-        items = [item for item in self.items if item.need_check()]
-        args_combinations = [i.args for i in items]
-        timestamp = int(time.time())
-        results = self.execute(args_combinations)
-        map(Item.checked, items)
-        self.sender.send_items(items, results, timestamp)
+    def check_job(self, items):
+        try:
+            self.check(items)
+        finally:
+            with self.update_lock:
+                self.checking = False
+                if self.pending:
+                    self.loop.call_soon(self.dispatch)
+
+    def check(self, items):
+        # items of different hosts with equal arguments (all but $hostname ones) are checked once
+        subscribers = {}
+        for item in items:
+            subscribers.setdefault(item.args, []).append(item)
+        args_combinations = subscribers.keys()
+        timestamp = time.time()
+        start = monotonic()
+        profiler.enter(self)
+        try:
+            results = self.execute(args_combinations)
+        finally:
+            elapsed = monotonic() - start
+            profiler.leave(elapsed)
+            stats.record('execute', elapsed)
+            stats.record(self.stats_name, elapsed)
+            stats.incr('checks', len(items))
+        for args, value in zip(args_combinations, results):
+            for item in subscribers[args]:
+                item_value = value
+                if item.preprocessor is not None:
+                    item_value = item.preprocessor.process(item, value, timestamp)
+                    if item_value is None:
+                        continue
+                if item.value_filter is None or item.value_filter.accept(item, item_value):
+                    self.send_queue.put(item.host, item.key, item_value, timestamp)
 
 sys.path.append(Script.bin_dir)
 os.environ['PATH'] = os.pathsep.join([os.environ['PATH'], Script.bin_dir])
 
+def intern_string(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return intern(s)
+
+def compile_key_pattern(pattern):
+    # item keys are full of regex and glob special characters, only '*' is a wildcard
+    return re.compile('^{0}$'.format('.*'.join(map(re.escape, pattern.split('*')))))
+
+class ValueFilter(object):
+    '''
+    Send-on-change for items matching key pattern ('*' matches anything).
+    A value is dropped when it differs from the last sent one by no more than
+    deadband (absolute, or percent of the last sent value with '%' suffix),
+    but one value is sent at least every heartbeat intervals (0 to disable).
+    '''
+    def __init__(self, line):
+        pattern, deadband, heartbeat = [s.strip() for s in line.rsplit(',', 2)]
+        self.pattern = pattern
+        self.pattern_re = compile_key_pattern(pattern)
+        self.relative = deadband.endswith('%')
+        self.deadband = float(deadband.rstrip('%'))
+        self.heartbeat = int(heartbeat)
+
+    def __str__(self):
+        return '<value filter {0}>'.format(self.pattern)
+
+    def matches(self, key):
+        return self.pattern_re.match(key) is not None
+
+    def accept(self, item, value):
+        # last sent value and number of values dropped after it are kept by the item
+        if item.last_value is not None and (not self.heartbeat or item.skipped + 1 < self.heartbeat) and self.unchanged(item.last_value, value):
+            item.skipped += 1
+            return False
+        item.last_value = value
+        item.skipped = 0
+        return True
+
+    def unchanged(self, last, value):
+        if value == last:
+            return True
+        if not self.deadband:
+            return False
+        try:
+            last, value = float(last), float(value)
+        except (TypeError, ValueError):
+            return False
+        if self.relative:
+            return abs(value - last) <= abs(last) * self.deadband / 100
+        return abs(value - last) <= self.deadband
+
+class RingBuffer(object):
+    '''last size numbers, in a flat array of doubles'''
+    __slots__ = ('values', 'pos', 'count')
+
+    def __init__(self, size):
+        self.values = array.array('d', [0.0]) * size
+        self.pos = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.values)
+        if self.count < len(self.values):
+            self.count += 1
+
+    def full(self):
+        return self.count == len(self.values)
+
+    def last(self):
+        return self.values[self.pos - 1]
+
+    def contents(self):
+        # order is not kept: aggregates don't need it
+        if self.count < len(self.values):
+            return self.values[:self.count]
+        return self.values
+
+    def clear(self):
+        self.pos = 0
+        self.count = 0
+
+aggregates = {
+    'avg': lambda buf: math.fsum(buf.contents()) / buf.count,
+    'min': lambda buf: min(buf.contents()),
+    'max': lambda buf: max(buf.contents()),
+    'sum': lambda buf: math.fsum(buf.contents()),
+    'last': lambda buf: buf.last(),
+}
+
+class ChangeStage(object):
+    '''difference from the previous value, or per second of clock; first value and counter resets give nothing'''
+    def __init__(self, per_second):
+        self.per_second = per_second
+
+    def new_state(self, item):
+        return [None, None]
+
+    def process(self, state, value, clock):
+        last, last_clock = state
+        state[0], state[1] = value, clock
+        if last is None or value < last:
+            return None
+        if self.per_second:
+            if clock <= last_clock:
+                return None
+            return (value - last) / (clock - last_clock)
+        return value - last
+
+class MovingStage(object):
+    '''aggregate of the last size values, sent every time'''
+    def __init__(self, function, size):
+        self.function = aggregates[function]
+        self.size = size
+
+    def new_state(self, item):
+        return RingBuffer(self.size)
+
+    def process(self, buf, value, clock):
+        buf.append(value)
+        return self.function(buf)
+
+class SampleStage(object):
+    '''item is checked every period seconds, aggregate of samples is sent once per item interval'''
+    def __init__(self, function, period):
+        self.function = aggregates[function]
+        self.period = period
+
+    def new_state(self, item):
+        return RingBuffer(max(1, int(round(item.interval / self.period))))
+
+    def process(self, buf, value, clock):
+        buf.append(value)
+        if not buf.full():
+            return None
+        value = self.function(buf)
+        buf.clear()
+        return value
+
+class Preprocessor(object):
+    '''
+    Per-item processing of checked values of items matching key pattern, before send.
+    Stages run in order, each one may hold the value back:
+      change, rate        difference from the previous value, change per second
+      avg:N, min:N, max:N aggregate of the last N values
+      sample:S[:F]        check every S seconds, send F (avg, min, max, sum or last;
+                          avg by default) of the samples once per item interval
+    Non-numeric values (ZBX_NOTSUPPORTED) are sent as is.
+    '''
+    def __init__(self, line):
+        pattern, stages = [s.strip() for s in line.rsplit(',', 1)]
+        self.pattern = pattern
+        self.pattern_re = compile_key_pattern(pattern)
+        self.stages = []
+        self.period = None
+        for stage in stages.split():
+            name, _, params = stage.partition(':')
+            params = params and params.split(':') or []
+            if name in ('change', 'rate'):
+                self.stages.append(ChangeStage(name == 'rate'))
+            elif name in ('avg', 'min', 'max'):
+                self.stages.append(MovingStage(name, int(params[0])))
+            elif name == 'sample':
+                if self.period is not None:
+                    raise ValueError('only one sample stage is allowed')
+                self.period = float(params[0])
+                self.stages.append(SampleStage(params[1:] and params[1] or 'avg', self.period))
+            else:
+                raise ValueError('unknown stage {0}'.format(stage))
+
+    def __str__(self):
+        return '<preprocessor {0}>'.format(self.pattern)
+
+    def matches(self, key):
+        return self.pattern_re.match(key) is not None
+
+    def process(self, item, value, clock):
+        # numbers are taken as they are, text output of shell checks is parsed
+        if not isinstance(value, (int, long, float)):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    return value
+        if item.state is None:
+            item.state = [stage.new_state(item) for stage in self.stages]
+        for stage, state in zip(self.stages, item.state):
+            value = stage.process(state, value, clock)
+            if value is None:
+                return None
+        return value
+
 class Item(object):
-    def __init__(self, host, key, interval, script, args):
-        self.host = host
-        self.key = key
+    # there may be hundreds of thousands of items with many virtual hosts
+    __slots__ = ('host', 'key', 'interval', 'script', 'args', 'deadline', 'timer', 'hash', 'value_filter', 'last_value', 'skipped',
+                 'preprocessor', 'state', 'period')
+
+    def __init__(self, host, key, interval, script, args, value_filter=None, preprocessor=None):
+        self.host = intern_string(host)
+        self.key = intern_string(key)
         self.interval = interval
         self.script = script
-        self.logger = logging.getLogger(host)
-        self.args = [arg == '$hostname' and host.rsplit('.', 1)[0] or arg for arg in args]
-        self.last_check_time = datetime(1, 1, 1)
+        hostname = self.host.rsplit('.', 1)[0]
+        self.args = tuple([arg == '$hostname' and hostname or intern_string(arg) for arg in args])
+        self.deadline = None
+        self.timer = None
+        self.hash = hash((self.host, self.key, interval))
+        self.value_filter = value_filter
+        self.last_value = None
+        self.skipped = 0
+        self.preprocessor = preprocessor
+        self.state = None
+        # sampling items are checked more often than their interval
+        self.period = preprocessor is not None and preprocessor.period or interval
 
     def __eq__(self, other):
-        return self.host == other.host and self.key == other.key and self.interval == other.interval
+        return self.hash == other.hash and self.host == other.host and self.key == other.key and self.interval == other.interval
 
     def __hash__(self):
-        return (self.host, self.key, self.interval).__hash__()
+        return self.hash
 
     def __str__(self):
         return self.key
 
-    def need_check(self):
-        return self.last_check_time + timedelta(0, self.interval) < datetime.now()
+    def schedule(self, deadline, callback):
+        self.deadline = deadline
+        self.timer = self.script.loop.call_at(deadline, callback, self)
+
+    def unschedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
 
-    def checked(self):
-        self.last_check_time = datetime.now()
+    def next_deadline(self, now):
+        # deadlines are on a fixed grid: late checks do not shift following ones;
+        # items of one script share the grid, so equal items of all hosts come due together
+        return now + self.period - (now - self.script.phase * self.period) % self.period
 
 class Host(object):
-    def __init__(self, name, options, scripts, sender):
+    def __init__(self, name, scripts, sender, in_shard=None, value_filters=(), preprocessors=()):
         self.name = name
-        self.update_interval = options.update_interval
         self.scripts = scripts
+        self.value_filters = value_filters
+        self.preprocessors = preprocessors
         self.logger = logging.getLogger(name)
         self.items = set()
         self.sender = sender
-        self.update_job = threading.Thread(target=self.update_loop)
-        self.update_job.daemon = True
-
-    def update_loop(self):
-        while True:
-            self.update_active_checks()
-            time.sleep(self.update_interval)
+        self.in_shard = in_shard
+        self.fingerprint = None
 
     item_re = re.compile('^((.+?)(\[(.+)\])?)$')
-    def update_active_checks(self):
+    def update_active_checks(self, checks=None):
+        '''applies active checks list, requested from server unless given; returns the list or None on failure'''
+        start = monotonic()
         try:
-            self.logger.debug('updating item list')
+            if checks is None:
+                self.logger.debug('updating item list')
+                checks = self.sender.get_active_checks(self.name)
+            fingerprint = hash(tuple(checks))
+            if fingerprint == self.fingerprint:
+                self.logger.debug('item list is not changed')
+                return checks
             retrieved_items = set()
-            for raw_key, interval in self.sender.get_active_checks(self.name):
+            for raw_key, interval in checks:
                 key, bare_key, args = self.item_re.match(raw_key).group(1, 2, 4)
-                for script in self.scripts:
-                    if script.key == bare_key:
-                       retrieved_items.add(Item(self.name, key, interval, script, args and args.split(',') or []))
-                       break
-            self.logger.debug('retrieved items: {0}'.format(', '.join(map(str, retrieved_items))))
+                script = self.scripts.get(bare_key)
+                args = args and args.split(',') or []
+                if script is not None and (self.in_shard is None or self.in_shard(script, self.name, args)):
+                    retrieved_items.add(Item(self.name, key, interval, script, args,
+                                             self.find_matching(self.value_filters, key), self.find_matching(self.preprocessors, key)))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('retrieved items: {0}'.format(', '.join(map(str, retrieved_items))))
             added_items = retrieved_items - self.items
             removed_items = self.items - retrieved_items
             self.items -= removed_items
@@ -307,23 +1607,505 @@ class Host(object):
             if removed_items:
                 self.logger.info('removed items: {0}'.format(', '.join(map(str, removed_items))))
 
-            for script in self.scripts:
-                script.update([item for item in added_items if item.script == script], [item for item in removed_items if item.script == script])
+            changes = {}
+            for item in added_items:
+                changes.setdefault(item.script, ([], []))[0].append(item)
+            for item in removed_items:
+                changes.setdefault(item.script, ([], []))[1].append(item)
+            for script, (added, removed) in changes.iteritems():
+                script.update(added, removed)
 
             if not self.items:
                 self.logger.info('no items')
+            self.fingerprint = fingerprint
+            return checks
         except Exception, e:
             self.logger.exception(e)#, 'failed to update active checks list')
+        finally:
+            stats.record('update', monotonic() - start)
+
+    def find_matching(self, rules, key):
+        # first matching value filter or preprocessor wins
+        for rule in rules:
+            if rule.matches(key):
+                return rule
+        return None
+
+class PassiveListener(object):
+    '''
+    Serves passive checks (zabbix_get, server polling) with the same scripts as active checks.
+    One thread accepts connections and reads requests, at most max_connections at a time;
+    checks run on a separate bounded worker pool. Values are cached for cache_ttl seconds,
+    and concurrent requests for one key wait for a single check.
+    '''
+    max_request = 65536
+    # descriptors kept free for server connections, spool, shell checks and coprocesses
+    fd_reserve = 128
+    # listening socket is not polled for this time after accept ran out of descriptors (seconds)
+    accept_backoff = 1
+
+    def __init__(self, options, scripts, hostname):
+        self.logger = logging.getLogger('PassiveListener')
+        self.scripts = scripts
+        self.hostname = hostname
+        self.timeout = options.timeout
+        self.cache_ttl = options.passive_cache_ttl
+        self.max_connections = options.passive_max_connections
+        fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if fd_limit != resource.RLIM_INFINITY and self.max_connections > fd_limit - self.fd_reserve:
+            self.max_connections = max(1, fd_limit - self.fd_reserve)
+            self.logger.warning('passive connections are limited to {0} by open files limit {1}'.format(self.max_connections, fd_limit))
+        self.accept_time = 0
+        self.allowed = set()
+        for name in filter(None, [options.server] + options.passive_allowed.split(',')):
+            self.allowed |= set(socket.gethostbyname_ex(name.strip())[2])
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((options.listen_address, options.listen_port))
+        self.sock.listen(128)
+        self.sock.setblocking(0)
+        self.pool = WorkerPool(options.passive_workers)
+        self.connections = {}
+        self.busy = 0
+        self.cache = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='passive')
+        self.thread.daemon = True
+
+    def start(self):
+        self.logger.info('listening on {0}:{1}'.format(*self.sock.getsockname()))
+        self.pool.start()
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.serve()
+            except Exception, e:
+                self.logger.exception(e)
+                time.sleep(1)
+
+    def serve(self):
+        readers = self.connections.keys()
+        if len(readers) + self.busy < self.max_connections and self.accept_time <= monotonic():
+            readers.append(self.sock)
+        for conn in select_readable(readers, 1):
+            if conn is self.sock:
+                self.accept()
+            elif conn in self.connections:
+                try:
+                    self.read(conn)
+                except Exception, e:
+                    self.logger.exception(e)
+                    if conn in self.connections:
+                        self.close(conn)
+        now = monotonic()
+        for conn, (buf, deadline) in self.connections.items():
+            if deadline < now:
+                self.logger.debug('closing idle connection')
+                self.close(conn)
+        with self.lock:
+            for key, (expire, value) in self.cache.items():
+                if expire < now:
+                    del self.cache[key]
+
+    def accept(self):
+        try:
+            conn, address = self.sock.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                # pending connection stays readable: stop polling it for a while instead of spinning
+                self.logger.warning('can\'t accept passive connection: {0}; retrying in {1} seconds'.format(e, self.accept_backoff))
+                self.accept_time = monotonic() + self.accept_backoff
+            return
+        if address[0] not in self.allowed:
+            self.logger.warning('rejecting connection from {0}'.format(address[0]))
+            conn.close()
+            return
+        conn.setblocking(0)
+        self.connections[conn] = ('', monotonic() + self.timeout)
+
+    def close(self, conn):
+        del self.connections[conn]
+        conn.close()
+
+    def read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except socket.error:
+            data = ''
+        if not data:
+            self.close(conn)
+            return
+        buf, deadline = self.connections[conn]
+        buf += data
+        key = None
+        if buf[:4] == 'ZBXD':
+            if len(buf) >= 13:
+                data_len = struct.unpack('<Q', buf[5:13])[0]
+                if data_len > self.max_request:
+                    self.close(conn)
+                    return
+                if len(buf) >= 13 + data_len:
+                    key = buf[13:13+data_len]
+        elif '\n' in buf:
+            key = buf.split('\n', 1)[0]
+        if key is None:
+            if len(buf) > self.max_request:
+                self.close(conn)
+            else:
+                self.connections[conn] = (buf, deadline)
+            return
+        del self.connections[conn]
+        self.dispatch(conn, key.strip())
+
+    def dispatch(self, conn, key):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] >= monotonic():
+                value = cached[1]
+            elif key in self.pending:
+                self.pending[key].append(conn)
+                self.busy += 1
+                return
+            else:
+                self.pending[key] = [conn]
+                self.busy += 1
+                self.pool.submit(self.check, key)
+                return
+        self.reply(conn, value)
+
+    def check(self, key):
+        try:
+            value = self.get_value(key)
+        except Exception, e:
+            self.logger.warning('failed to check {0}: {1}'.format(key, e))
+            value = 'ZBX_NOTSUPPORTED'
+        with self.lock:
+            self.cache[key] = (monotonic() + self.cache_ttl, value)
+            conns = self.pending.pop(key)
+            self.busy -= len(conns)
+        for conn in conns:
+            self.reply(conn, value)
+
+    def get_value(self, key):
+        match = Host.item_re.match(key)
+        if match is None:
+            return 'ZBX_NOTSUPPORTED'
+        bare_key, args = match.group(2, 4)
+        script = self.scripts.get(bare_key)
+        if script is None:
+            return 'ZBX_NOTSUPPORTED'
+        args = tuple([arg == '$hostname' and self.hostname or arg for arg in args and args.split(',') or []])
+        return script.execute([args])[0]
+
+    def reply(self, conn, value):
+        value = str(value)
+        try:
+            conn.setblocking(1)
+            conn.settimeout(self.timeout)
+            conn.sendall('ZBXD\x01{0}{1}'.format(struct.pack('<Q', len(value)), value))
+        except socket.error, e:
+            self.logger.debug('failed to send reply: {0}'.format(e))
+        conn.close()
+
+class HashRing(object):
+    '''consistent hashing of keys to shards'''
+    replicas = 100
+
+    def __init__(self, shards):
+        self.ring = sorted((zlib.crc32('{0}-{1}'.format(shard, i)) & 0xffffffff, shard) for shard in range(shards) for i in range(self.replicas))
+        self.hashes = [h for h, shard in self.ring]
+
+    def get(self, key):
+        return self.ring[bisect.bisect(self.hashes, zlib.crc32(key) & 0xffffffff) % len(self.ring)][1]
+
+class ShardPipe(object):
+    '''send queue of a worker process: values are passed to supervisor, one JSON line each'''
+    def __init__(self, stream):
+        self.logger = logging.getLogger('ShardPipe')
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def put(self, host, key, value, clock):
+        line = json.dumps((host, key, value, clock)) + '\n'
+        with self.lock:
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except IOError, e:
+                self.logger.error('supervisor is gone ({0}), exiting'.format(e))
+                os._exit(1)
+
+class Supervisor(object):
+    '''
+    Runs worker processes, each checking its shard of items, restarts crashed
+    ones and passes their values to the send queue of this process.
+    Active checks are requested from server here, once per host, and passed
+    to every worker on its stdin as one JSON line per changed host.
+    '''
+    restart_delay = 5
+    # agent.stats metrics kept by this process, which sends values and requests active checks;
+    # their items are checked here, items of other metrics by a worker
+    stats_metrics = frozenset(['sent', 'send_errors', 'dropped', 'spooled', 'replayed',
+                               'request', 'request_errors', 'update', 'send_queue', 'spool'])
+
+    def __init__(self, options, send_queue):
+        self.logger = logging.getLogger('Supervisor')
+        self.processes = options.processes
+        self.send_queue = send_queue
+        # workers get the same command line, without daemonizing, spooling and passive checks
+        self.argv = [sys.executable] + sys.argv + ['--daemonize=0', '--stop=0', '--spool-dir=', '--listen-port=0']
+        self.workers = {}
+        self.restarts = []
+        # last active checks line of every host, replayed to restarted workers
+        self.checks = {}
+        self.lock = threading.Lock()
+
+    def spawn(self, shard):
+        self.logger.info('starting worker {0}'.format(shard))
+        proc = subprocess.Popen(self.argv + ['--shard={0}'.format(shard)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        with self.lock:
+            self.workers[proc.stdout.fileno()] = [shard, proc, '']
+            for line in self.checks.itervalues():
+                self.write(proc, line)
+
+    def write(self, proc, line):
+        try:
+            proc.stdin.write(line)
+            proc.stdin.flush()
+        except (IOError, ValueError), e:
+            # worker is exiting, it's restarted when its stdout is closed
+            self.logger.debug('can\'t pass active checks to worker {0}: {1}'.format(proc.pid, e))
+
+    def update_active_checks(self, host):
+        # host applies the items checked here and returns the whole list for workers
+        checks = host.update_active_checks()
+        if checks is None:
+            return
+        line = json.dumps((host.name, checks)) + '\n'
+        with self.lock:
+            if self.checks.get(host.name) == line:
+                return
+            self.checks[host.name] = line
+            for shard, proc, buf in self.workers.values():
+                self.write(proc, line)
+
+    def terminate(self, signum, frame):
+        self.logger.info('stopping workers')
+        for shard, proc, buf in self.workers.values():
+            try:
+                proc.terminate()
+            except OSError:
+                pass
+        sys.exit(0)
+
+    def start(self):
+        signal.signal(signal.SIGTERM, self.terminate)
+        map(self.spawn, range(self.processes))
+
+    def run(self):
+        while True:
+            now = monotonic()
+            for restart_time, shard in list(self.restarts):
+                if restart_time <= now:
+                    self.restarts.remove((restart_time, shard))
+                    self.spawn(shard)
+            for fd in select_readable(self.workers.keys(), 1):
+                self.read(fd)
+
+    def read(self, fd):
+        worker = self.workers[fd]
+        data = os.read(fd, 65536)
+        if not data:
+            shard, proc = worker[:2]
+            with self.lock:
+                del self.workers[fd]
+            proc.stdout.close()
+            proc.stdin.close()
+            self.logger.error('worker {0} exited with code {1}, restarting in {2} seconds'.format(shard, proc.wait(), self.restart_delay))
+            self.restarts.append((monotonic() + self.restart_delay, shard))
+            return
+        lines = (worker[2] + data).split('\n')
+        worker[2] = lines.pop()
+        for line in lines:
+            try:
+                host, key, value, clock = json.loads(line)
+            except ValueError, e:
+                self.logger.error('skipping bad line from worker {0}: {1!r}: {2}'.format(worker[0], line[:200], e))
+                continue
+            self.send_queue.put(host.encode('utf-8'), key.encode('utf-8'), value, clock)
+
+class Manifest(object):
+    '''
+    Startup cache of parsed conf.d files, kept while file mtime and size are
+    unchanged, so restarts don't read and parse every config again.
+    '''
+    def __init__(self, path):
+        self.logger = logging.getLogger('Manifest')
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        self.changed = False
+        if path:
+            try:
+                self.entries = json.load(open(path))
+            except (IOError, ValueError), e:
+                self.logger.info('manifest {0} is not loaded: {1}'.format(path, e))
+
+    def stamp(self, path):
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != self.stamp(path):
+            return None
+        self.used[path] = entry
+        return entry[1]
+
+    def set(self, path, data):
+        self.used[path] = [self.stamp(path), data]
+        self.changed = True
+
+    def save(self):
+        # only entries of files seen by this run are kept, so removed files are forgotten
+        if not self.path or not (self.changed or len(self.used) != len(self.entries)):
+            return
+        try:
+            tmp_path = '{0}.{1}'.format(self.path, os.getpid())
+            f = open(tmp_path, 'w')
+            json.dump(self.used, f)
+            f.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            self.logger.warning('can\'t save manifest {0}: {1}'.format(self.path, e))
 
 class Agent(object):
     def __init__(self):
         self.scripts = []
+        self.value_filters = []
+        self.preprocessors = []
         self.coupled_items = []
         self.logger = logging.getLogger()
         self.load_config()
+        self.setup_proc_snapshots()
+        self.loop = Loop(self.options.workers)
         self.sender = Sender(self.options)
+        self.supervisor = None
+        if self.options.shard >= 0:
+            # worker process: stdout and stdin are the channels to supervisor, anything else printed
+            # goes to stderr and checks can't read supervisor's data
+            self.send_queue = ShardPipe(os.fdopen(os.dup(1), 'w'))
+            os.dup2(2, 1)
+            self.checks_pipe = os.fdopen(os.dup(0), 'r')
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.close(devnull)
+            self.supervisor_pid = os.getppid()
+        else:
+            self.send_queue = SendQueue(self.sender, self.options)
+        self.shell_runner = ShellRunner(self.options, Script.bin_dir)
+        self.manifest = Manifest(self.options.manifest_cache)
         self.load_zabbix_configs()
-        self.hosts = [Host(hostname, self.options, self.scripts, self.sender) for hostname in self.get_virtual_hosts()]
+        self.manifest.save()
+        # self-monitoring items are answered from this process' stats
+        self.stats_script = Script('agent.stats[*],agent.stats $1 $2', self.send_queue, self.loop, self.shell_runner)
+        self.stats_script.execute = stats.vmain
+        self.scripts.append(self.stats_script)
+        self.setup_stats()
+        # first script wins for duplicated keys
+        self.scripts_by_key = {}
+        for script in self.scripts:
+            self.scripts_by_key.setdefault(script.key, script)
+        if self.options.shard >= 0:
+            self.shard_ring = HashRing(self.options.processes)
+        self.hosts = map(self.make_host, self.get_virtual_hosts())
+        self.listener = None
+        if self.options.listen_port:
+            self.listener = PassiveListener(self.options, self.scripts_by_key, self.hosts[0].name.rsplit('.', 1)[0])
+
+    def make_host(self, hostname):
+        in_shard = None
+        if self.options.shard >= 0:
+            in_shard = self.in_shard
+        elif self.options.processes > 1:
+            in_shard = self.in_supervisor
+        return Host(hostname, self.scripts_by_key, self.sender, in_shard, self.value_filters, self.preprocessors)
+
+    def setup_stats(self):
+        stats.gauge('items', lambda: sum(len(script.items) for script in self.scripts))
+        stats.gauge('backlog', lambda: sum(len(script.pending) for script in self.scripts))
+        stats.gauge('jobs', self.loop.pool.jobs.qsize)
+        stats.gauge('timers', lambda: len(self.loop.timers))
+        if isinstance(self.send_queue, SendQueue):
+            stats.gauge('send_queue', self.send_queue.queue.qsize)
+            if self.send_queue.spool is not None:
+                stats.gauge('spool', self.send_queue.spool.size)
+
+    def rotate_stats(self):
+        self.loop.call_later(self.options.stats_window, self.rotate_stats)
+        stats.rotate()
+
+    def dump_stats(self, signum, frame):
+        stats.dump()
+
+    def in_supervisor(self, script, host, args):
+        return script is self.stats_script and len(args) > 0 and args[0] in Supervisor.stats_metrics
+
+    def in_shard(self, script, host, args):
+        # all hosts' items of a script go to one worker, so they are checked once;
+        # items depending on host name can't be shared and are spread by host
+        if self.in_supervisor(script, host, args):
+            return False
+        key = script.key
+        if '$hostname' in args:
+            key += '\0' + host
+        return self.shard_ring.get(key) == self.options.shard
+
+    def watch_supervisor(self):
+        if os.getppid() != self.supervisor_pid:
+            self.logger.error('supervisor is gone, exiting')
+            os._exit(1)
+        self.loop.call_later(5, self.watch_supervisor)
+
+    def start_hosts(self):
+        # hosts are refreshed in batches: one job per batch, sharing pooled connection
+        size = self.options.update_batch_size
+        for i in range(0, len(self.hosts), size):
+            self.loop.call_soon(self.update_loop, self.hosts[i:i+size])
+
+    def update_loop(self, hosts):
+        self.loop.run_in_executor(self.update_hosts, hosts)
+
+    def update_hosts(self, hosts):
+        try:
+            for host in hosts:
+                if self.supervisor is not None:
+                    self.supervisor.update_active_checks(host)
+                else:
+                    host.update_active_checks()
+        finally:
+            # the next refresh is counted from the end of this one, so refreshes of a batch never overlap
+            self.loop.call_later(self.options.update_interval, self.update_loop, hosts)
+
+    def read_checks(self):
+        '''worker process: applies active checks lists passed by supervisor'''
+        hosts = dict((host.name, host) for host in self.hosts)
+        for line in iter(self.checks_pipe.readline, ''):
+            try:
+                hostname, checks = json.loads(line)
+            except ValueError, e:
+                self.logger.error('skipping bad active checks line: {0!r}: {1}'.format(line[:200], e))
+                continue
+            hostname = hostname.encode('utf-8')
+            host = hosts.get(hostname)
+            if host is None:
+                host = hosts[hostname] = self.make_host(hostname)
+            host.update_active_checks([(key, interval) for key, interval in checks])
+        self.logger.error('supervisor is gone, exiting')
+        os._exit(1)
 
     def get_sleep_time(self):
         return self.sleep_time
@@ -331,23 +2113,82 @@ class Agent(object):
     def load_config(self):
         parser = config.config_parser('zabbix-agent-ng')
         parser.add_argument('--update-interval', type=int, default=120, help='items update interval')
+        parser.add_argument('--update-batch-size', type=int, default=20, help='number of hosts which items are updated in one job')
         parser.add_argument('--server', help='zabbix feeder server')
         parser.add_argument('--port', type=int, default=10051, help='zabbix feeder port')
+        parser.add_argument('--connect-timeout', type=float, default=5, help='zabbix feeder connect timeout (seconds)')
+        parser.add_argument('--timeout', type=float, default=30, help='zabbix feeder response timeout (seconds)')
+        parser.add_argument('--max-idle-connections', type=int, default=8, help='number of idle connections to zabbix feeder kept for reuse')
+        parser.add_argument('--idle-timeout', type=float, default=60, help='close idle connections to zabbix feeder after this time (seconds)')
         parser.add_argument('--pid-file', default='/var/run/zabbix-agent-ng.pid', help='path to pid file')
         parser.add_argument('--zabbix-conf-dir', default='/etc/zabbix', help='path to zabbix config')
         parser.add_argument('--daemonize', type=int, default=0, help='daemonize after start')
         parser.add_argument('--stop', type=int, default=0, help='stop after start')
         parser.add_argument('--protocol', default='1.8', help='feeder protocol version')
         parser.add_argument('--hosts', default='', help='virtual hosts list (separated by commas)')
+        parser.add_argument('--send-batch-size', type=int, default=250, help='maximum number of values sent in one request')
+        parser.add_argument('--max-request-size', type=int, default=1024*1024, help='maximum size of values request for protocol 2.0 (bytes)')
+        parser.add_argument('--compress', type=int, default=0, help='compress requests for protocol 2.0 (zabbix 4.0+ server)')
+        parser.add_argument('--send-flush-interval', type=float, default=1, help='maximum time a value waits for a batch to fill (seconds)')
+        parser.add_argument('--send-queue-size', type=int, default=10000, help='number of values waiting for send before checks are blocked')
+        parser.add_argument('--spool-dir', default='/var/spool/zabbix-agent-ng', help='directory for values not accepted by server (empty to disable)')
+        parser.add_argument('--spool-max-size', type=int, default=100*1024*1024, help='maximum spool size (bytes)')
+        parser.add_argument('--spool-segment-size', type=int, default=1024*1024, help='spool segment file size (bytes)')
+        parser.add_argument('--spool-eviction', default='oldest', help='values dropped when spool is full: oldest or newest')
+        parser.add_argument('--spool-replay-rate', type=float, default=1000, help='maximum rate of spooled values replay (values per second)')
+        parser.add_argument('--shell-max-procs', type=int, default=4, help='maximum number of concurrently running shell checks')
+        parser.add_argument('--shell-timeout', type=float, default=30, help='shell check timeout (seconds)')
+        parser.add_argument('--proc-snapshot-ttl', type=float, default=0.5, help='time collectors share one read of a /proc file (seconds)')
+        parser.add_argument('--listen-port', type=int, default=0, help='port for passive checks (0 to disable)')
+        parser.add_argument('--listen-address', default='0.0.0.0', help='address for passive checks')
+        parser.add_argument('--passive-allowed', default='', help='hosts allowed to make passive checks besides server (separated by commas)')
+        parser.add_argument('--passive-max-connections', type=int, default=1000, help='maximum number of passive checks connections')
+        parser.add_argument('--passive-workers', type=int, default=4, help='number of threads running passive checks')
+        parser.add_argument('--passive-cache-ttl', type=float, default=1, help='time passive check value is reused (seconds)')
+        parser.add_argument('--processes', type=int, default=1, help='number of worker processes checking items')
+        parser.add_argument('--shard', type=int, default=-1, help='shard checked by this worker process (set by supervisor)')
+        parser.add_argument('--workers', type=int, default=8, help='number of threads running checks and network requests')
+        parser.add_argument('--stats-window', type=float, default=60, help='time latency percentiles are computed over (seconds)')
+        parser.add_argument('--manifest-cache', default='/var/cache/zabbix-agent-ng/manifest.json', help='cache of parsed conf.d files (empty to disable)')
+        parser.add_argument('--dns-timeout', type=float, default=2, help='time to wait for own host name resolution (seconds)')
+        parser.add_argument('--slow-check-threshold', type=float, default=0, help='profile and log checks running longer (seconds, 0 to disable)')
         parser.parse()
         self.options = parser.options
         parser.init_logging()
 
+    def setup_proc_snapshots(self):
+        # collector modules share /proc reads through zbx_procfs from bin dir
+        try:
+            zbx_procfs = __import__('zbx_procfs')
+        except ImportError:
+            self.logger.warning('zbx_procfs is not found in {0}, /proc snapshots are not shared'.format(Script.bin_dir))
+            return
+        zbx_procfs.ttl = self.options.proc_snapshot_ttl
+
     def get_virtual_hosts(self):
-        yield socket.gethostbyaddr(socket.gethostname())[0]
+        yield self.resolve_hostname()
         hostname = socket.gethostname()
         for vhost in self.options.hosts.split(','):
-            yield '{1}.{0}'.format(hostname, vhost)
+            if vhost.strip():
+                yield '{1}.{0}'.format(hostname, vhost.strip())
+
+    def resolve_hostname(self):
+        # reverse lookup may hang on broken DNS: it's waited for dns_timeout at most
+        hostname = socket.gethostname()
+        result = []
+        def resolve():
+            try:
+                result.append(socket.gethostbyaddr(hostname)[0])
+            except socket.error, e:
+                self.logger.warning('can\'t resolve {0}: {1}'.format(hostname, e))
+        thread = threading.Thread(target=resolve, name='resolver')
+        thread.daemon = True
+        thread.start()
+        thread.join(self.options.dns_timeout)
+        if not result:
+            self.logger.warning('using {0} as host name, it is not resolved in {1} seconds'.format(hostname, self.options.dns_timeout))
+            return hostname
+        return result[0]
 
     def load_zabbix_configs(self):
         conf_d = os.path.join(self.options.zabbix_conf_dir, 'conf.d')
@@ -357,21 +2198,48 @@ class Agent(object):
 
     def load_zabbix_config(self, full_path):
         try:
-            for line in open(full_path).readlines():
-                if line[0] == '#' or line == '\n':
-                    continue
-                name, val = line.split('=', 1)
+            directives = self.manifest.get(full_path)
+            if directives is None:
+                directives = self.read_zabbix_config(full_path)
+                self.manifest.set(full_path, directives)
+            for name, val in directives:
+                val = val.encode('utf-8')
                 if name == 'UserParameter':
-                    self.parse_config_line(val[:-1])
+                    self.parse_config_line(val)
+                elif name == 'UserParameterWorker':
+                    self.parse_config_line(val, worker=True)
+                elif name == 'ValueFilter':
+                    self.parse_rule(ValueFilter, self.value_filters, val)
+                elif name == 'Preprocess':
+                    self.parse_rule(Preprocessor, self.preprocessors, val)
         except BaseException, e:
             logging.warning('can\'t load config file {0}: {1}'.format(full_path, e))
 
-    def parse_config_line(self, line):
+    def read_zabbix_config(self, full_path):
+        directives = []
+        for number, line in enumerate(open(full_path).readlines(), 1):
+            if line[0] == '#' or line == '\n':
+                continue
+            name, val = line.split('=', 1)
+            try:
+                directives.append((name, val.rstrip('\n').decode('utf-8')))
+            except UnicodeDecodeError, e:
+                # one bad line doesn't drop the other directives of the file
+                self.logger.warning('skipping line {0} of config file {1}: {2}'.format(number, full_path, e))
+        return directives
+
+    def parse_config_line(self, line, worker=False):
         try:
-            self.scripts.append(Script(line, self.sender))
+            self.scripts.append(Script(line, self.send_queue, self.loop, self.shell_runner, worker))
         except BaseException, e:
             logging.warning('can\'t parse line {0}: {1}'.format(line, e))
 
+    def parse_rule(self, rule_class, rules, line):
+        try:
+            rules.append(rule_class(line))
+        except BaseException, e:
+            logging.warning('can\'t parse {0} line {1}: {2}'.format(rule_class.__name__, line, e))
+
     def daemonize(self):
         self.context = daemon.DaemonContext()
         # ugly hack to prevent closing of epoll queue
@@ -385,10 +2253,36 @@ class Agent(object):
             os.kill(os.getpid(), signal.SIGSTOP)
         if self.options.daemonize:
             self.daemonize()
-        setproctitle('zabbix-agent-ng')
-        map(lambda h: h.update_job.start(), self.hosts)
-        signal.pause()
-        self.logger.info('exiting')
+        if self.options.shard >= 0:
+            setproctitle('zabbix-agent-ng: worker {0}'.format(self.options.shard))
+            self.loop.call_soon(self.watch_supervisor)
+        else:
+            setproctitle('zabbix-agent-ng')
+            self.send_queue.start()
+        if self.listener is not None:
+            self.listener.start()
+        signal.signal(signal.SIGUSR1, self.dump_stats)
+        # blocking reads and writes of any thread are restarted after the dump; selects are retried
+        signal.siginterrupt(signal.SIGUSR1, False)
+        self.loop.call_later(self.options.stats_window, self.rotate_stats)
+        if self.options.slow_check_threshold:
+            profiler.start(self.loop, self.options.slow_check_threshold)
+        if self.options.processes > 1 and self.options.shard < 0:
+            self.supervisor = Supervisor(self.options, self.send_queue)
+            self.supervisor.start()
+            self.start_hosts()
+            self.loop.start()
+            self.supervisor.run()
+        if self.options.shard >= 0:
+            thread = threading.Thread(target=self.read_checks, name='read_checks')
+            thread.daemon = True
+            thread.start()
+        else:
+            self.start_hosts()
+        self.loop.start()
+        # signals (SIGUSR1) interrupt pause; SIGTERM terminates
+        while True:
+            signal.pause()
 
 if __name__ == '__main__':
     a = Agent()
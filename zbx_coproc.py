@@ -0,0 +1,61 @@
+#!/usr/bin/python
+'''
+Runs python collector module as zabbix-agent-ng coprocess worker.
+
+UserParameterWorker=proc.mem[*],zbx_coproc.py zbx_procmem vms $1 $2 $3 $4
+starts 'zbx_coproc.py zbx_procmem vms --worker' once and feeds it batches
+of ($1, $2, $3, $4) tuples; fixed arguments are prepended to each tuple.
+'''
+
+import sys
+import re
+
+def escape(field):
+    return str(field).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def unescape(field):
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n'}.get(m.group(1), m.group(1)), field)
+
+def read_batch(stream):
+    count = stream.readline()
+    if not count:
+        return None
+    return [map(unescape, stream.readline()[:-1].split('\t')) for i in range(int(count))]
+
+def write_batch(stream, values):
+    stream.write('{0}\n{1}'.format(len(values), ''.join(escape(value) + '\n' for value in values)))
+    stream.flush()
+
+def serve(vmain, fixed_args=[], stdin=sys.stdin, stdout=sys.stdout):
+    while True:
+        combinations = read_batch(stdin)
+        if combinations is None:
+            break
+        if not combinations:
+            write_batch(stdout, [])
+            continue
+        try:
+            values = vmain([fixed_args + args for args in combinations])
+        except Exception, e:
+            sys.stderr.write('failed to check {0}: {1}\n'.format(combinations, e))
+            values = ['ZBX_NOTSUPPORTED'] * len(combinations)
+        write_batch(stdout, values)
+
+def main_to_vmain(main):
+    def vmain(combinations):
+        results = []
+        for args in combinations:
+            try:
+                results.append(main(*args))
+            except Exception, e:
+                sys.stderr.write('failed to check {0}: {1}\n'.format(args, e))
+                results.append('ZBX_NOTSUPPORTED')
+        return results
+    return vmain
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[-1] != '--worker':
+        print('usage: {0} <module> [args] --worker'.format(sys.argv[0]))
+        sys.exit(1)
+    module = __import__(sys.argv[1])
+    serve(getattr(module, 'vmain', None) or main_to_vmain(module.main), sys.argv[2:-1])
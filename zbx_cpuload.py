@@ -1,2 +1,4 @@
+import zbx_procfs
+
 def main():
-    return open('/proc/loadavg').readline().split(' ', 1)[0]
+    return zbx_procfs.read('loadavg').split(' ', 1)[0]
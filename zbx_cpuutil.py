@@ -1,27 +1,135 @@
-def get_stat(lines, cpu, counter_name):
+import re
+import sys
+import logging
+import threading
+from array import array
+import zbx_procfs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+counters = ['user', 'nice', 'system', 'idle', 'wait', 'irq', 'softirq', 'steal', 'guest']
+# guest time is already accounted in user, so it's not a part of total
+total_counters = len(counters) - 1
+# percent modes also provide busy = 100 - idle - wait
+pct_counters = counters + ['busy']
+
+class CpuStat(object):
+    '''all cpu lines of /proc/stat as a (cpus x counters) matrix; row 0 is the 'cpu' total line'''
+    def __init__(self, data):
+        self.names = []
+        rows = []
+        for line in data.splitlines():
+            if not line.startswith('cpu'):
+                break
+            fields = line.split()
+            self.names.append(fields[0])
+            row = fields[1:len(counters)+1]
+            rows.append(row + ['0'] * (len(counters) - len(row)))
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        if numpy is not None:
+            self.values = numpy.array(rows, dtype=numpy.float64)
+        else:
+            self.values = [array('d', map(float, values)) for values in rows]
+
+def compute_percents(prev, cur):
+    '''returns (cpus x pct_counters) matrix of percents of time spent between two snapshots'''
+    idle, wait = counters.index('idle'), counters.index('wait')
+    if numpy is not None:
+        delta = cur.values - prev.values
+        total = delta[:, :total_counters].sum(axis=1)
+        total[total <= 0] = 1
+        pct = delta * 100.0 / total[:, numpy.newaxis]
+        return numpy.column_stack((pct, 100.0 - pct[:, idle] - pct[:, wait]))
+    percents = []
+    for prev_row, cur_row in zip(prev.values, cur.values):
+        delta = [c - p for c, p in zip(cur_row, prev_row)]
+        total = sum(delta[:total_counters])
+        if total <= 0:
+            total = 1
+        row = array('d', [d * 100.0 / total for d in delta])
+        row.append(100.0 - row[idle] - row[wait])
+        percents.append(row)
+    return percents
+
+# latest snapshot and percents between it and the previous one
+current = None
+percents = None
+lock = threading.Lock()
+
+def get_snapshot():
+    global current, percents
+    stat = zbx_procfs.parse('stat', CpuStat)
+    with lock:
+        if stat is not current:
+            if current is not None and current.names == stat.names:
+                percents = compute_percents(current, stat)
+            else:
+                # first read or cpu hotplug
+                percents = None
+            current = stat
+        return stat, percents
+
+top_re = re.compile('^top([0-9]+)$')
+
+def get_pct(stat, pct, cpu, counter_name):
+    if pct is None:
+        return None
+    column = pct_counters.index(counter_name)
+    if cpu == 'all':
+        return round(pct[0][column], 2)
+    if cpu.isdigit():
+        row = stat.index.get('cpu' + cpu)
+        if row is None:
+            return None
+        return round(pct[row][column], 2)
+    cores = [pct[i][column] for i in range(1, len(stat.names))]
+    if cpu == 'max':
+        return round(max(cores), 2)
+    elif cpu == 'min':
+        return round(min(cores), 2)
+    elif cpu == 'avg':
+        return round(sum(cores) / len(cores), 2)
+    top = top_re.match(cpu)
+    if top:
+        busiest = sorted(range(len(cores)), key=cores.__getitem__, reverse=True)[:int(top.group(1))]
+        return ','.join(stat.names[i + 1][3:] for i in busiest)
+    raise ValueError('invalid cpu {0}: must be one of all, <number>, max, min, avg or top<number>'.format(cpu))
+
+def get_stat(stat, pct, cpu, counter_name, mode=''):
+    if mode == 'pct':
+        return get_pct(stat, pct, cpu, counter_name)
+    elif mode != '':
+        raise ValueError('invalid mode {0}: must be <empty string> or pct'.format(mode))
     if cpu == 'all':
-        cpu = 'cpu '
+        cpu = 'cpu'
     else:
-        cpu = 'cpu{0} '.format(cpu)
-    for line in lines:
-        if line.startswith(cpu):
-            user, nice, system, idle, wait, irq, softirq, steal, guest = line[4:].split(' ')[1:10]
-            if type(counter_name) is list:
-                return [locals()[name] for name in counter_name]
-            else:
-                return locals()[counter_name]
+        cpu = 'cpu{0}'.format(cpu)
+    row = stat.index.get(cpu)
+    if row is None:
+        return None
+    values = stat.values[row]
+    if type(counter_name) is list:
+        return [int(values[counters.index(name)]) for name in counter_name]
+    else:
+        return int(values[counters.index(counter_name)])
 
-def main(cpu, counter_name):
-    return get_stat(open('/proc/stat').readlines(), cpu, counter_name)
+def main(cpu, counter_name, mode=''):
+    return get_stat(*(get_snapshot() + (cpu, counter_name, mode)))
 
 def vmain(combinations):
-    lines = open('/proc/stat').readlines()
+    stat, pct = get_snapshot()
     results = []
     for args in combinations:
-        results.append(get_stat(lines, *args))
+        try:
+            results.append(get_stat(stat, pct, *args))
+        except ValueError, e:
+            logging.getLogger('zabbix-agent-ng').warning('invalid system.cpu.util arguments {0}: {1}'.format(args, e))
+            results.append('ZBX_NOTSUPPORTED')
 
     return results
 
 if __name__ == '__main__':
-    import sys
     print(main(sys.argv[1], sys.argv[2].split(',')))
@@ -1,33 +1,176 @@
 import os
-import itertools
+import sys
+import time
+import logging
+import threading
+import collections
+import zbx_procfs
+
+# statvfs or path resolution running longer is abandoned and not tried again for retry_interval (seconds)
+timeout = 5
+retry_interval = 60
+# symlinks in item paths are resolved again after this time (seconds)
+resolve_ttl = 60
 
 def get_stat(s, mode):
     result = {'total': s.f_frsize * s.f_blocks,
-              'avail': s.f_bavail * s.f_bsize,
-              'free': s.f_bfree * s.f_bsize,
+              'avail': s.f_bavail * s.f_frsize,
+              'free': s.f_bfree * s.f_frsize,
               'itotal': s.f_files,
               'iavail': s.f_favail,
               'ifree': s.f_ffree}
     return result[mode]
 
+def unescape(field):
+    # mount points have space, tab, newline and backslash as octal escapes
+    return field.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+class MountTable(object):
+    '''mount points of /proc/self/mountinfo; path lookups are memoized per table'''
+    def __init__(self, data):
+        mount_points = set(unescape(line.split(' ', 5)[4]) for line in data.splitlines() if line)
+        # longest first, so the innermost mount matches
+        self.mount_points = sorted(mount_points, key=len, reverse=True)
+        self.found = {}
+
+    def find(self, path):
+        # lexical match: path must be resolved already, resolving symlinks here may hang
+        mount_point = self.found.get(path)
+        if mount_point is None:
+            normalized = os.path.normpath(path)
+            mount_point = normalized
+            for m in self.mount_points:
+                if normalized == m or normalized.startswith(m.rstrip('/') + '/'):
+                    mount_point = m
+                    break
+            self.found[path] = mount_point
+        return mount_point
+
+Pending = collections.namedtuple('Pending', 'thread result start_time')
+
+class Watchdog(object):
+    '''
+    Result of call(path), run on a watchdog thread and shared for ttl()
+    seconds. Concurrent callers wait for the call in flight, at most until
+    its timeout. A call which hangs or fails is a circuit breaker: it is not
+    tried again for retry_interval, and never while the hung call is still
+    running.
+    '''
+    def __init__(self, name, path, call, ttl):
+        self.name = name
+        self.path = path
+        self.call = call
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.thread = None
+        self.result = None
+        self.start_time = 0
+        self.value = None
+        self.timestamp = 0
+        self.retry_time = 0
+
+    def start(self):
+        '''returns the fresh value, None while the breaker is open, or the call in flight as Pending'''
+        now = time.time()
+        with self.lock:
+            if self.value is not None and self.timestamp + self.ttl() > now:
+                return self.value
+            if now < self.retry_time:
+                return None
+            if self.thread is None:
+                self.result = []
+                self.start_time = now
+                self.thread = threading.Thread(target=self.run, args=(self.result,), name='{0} {1}'.format(self.name, self.path))
+                self.thread.daemon = True
+                self.thread.start()
+            return Pending(self.thread, self.result, self.start_time)
+
+    def wait(self, pending, deadline):
+        pending.thread.join(max(0, min(deadline, pending.start_time + timeout) - time.time()))
+        with self.lock:
+            if not pending.result:
+                now = time.time()
+                if now >= self.retry_time:
+                    logging.getLogger('zabbix-agent-ng').error('{0}({1}) is not done in {2} seconds'.format(self.name, self.path, timeout))
+                    self.retry_time = now + retry_interval
+                return None
+            if isinstance(pending.result[0], OSError):
+                return None
+            return pending.result[0]
+
+    def run(self, result):
+        try:
+            value = self.call(self.path)
+        except OSError, e:
+            logging.getLogger('zabbix-agent-ng').error('{0}({1}) failed: {2}'.format(self.name, self.path, e))
+            value = e
+        with self.lock:
+            if isinstance(value, OSError):
+                self.retry_time = time.time() + retry_interval
+            else:
+                self.value = value
+                self.timestamp = self.start_time
+            self.thread = None
+            result.append(value)
+
+def resolve(path):
+    '''item path with symlinks resolved, so it's matched to the mount it is on; fails for missing paths'''
+    real_path = os.path.realpath(path)
+    os.stat(real_path)
+    return real_path
+
+def mount_ttl():
+    return zbx_procfs.ttl
+
+def path_ttl():
+    return resolve_ttl
+
+mounts = {}
+paths = {}
+watchdogs_lock = threading.Lock()
+
+def get_watchdog(watchdogs, path, name, call, ttl):
+    with watchdogs_lock:
+        watchdog = watchdogs.get(path)
+        if watchdog is None:
+            watchdog = watchdogs[path] = Watchdog(name, path, call, ttl)
+        return watchdog
+
+def get_all(watchdogs):
+    '''values of watchdogs, all calls are started at once and waited for until one deadline'''
+    deadline = time.time() + timeout
+    values = [watchdog.start() for watchdog in watchdogs]
+    for i, watchdog in enumerate(watchdogs):
+        if isinstance(values[i], Pending):
+            values[i] = watchdog.wait(values[i], deadline)
+    return values
+
+def get_mount_table():
+    try:
+        return zbx_procfs.parse('self/mountinfo', MountTable)
+    except IOError:
+        return MountTable('')
+
 def main(path, mode):
-    return get_stat(os.statvfs(path), mode)
+    return vmain([(path, mode)])[0]
 
 def vmain(combinations):
-    combinations = map(tuple, combinations)
-    results_dict = {}
-    for path, grouped_combinations in itertools.groupby(combinations, lambda c: c[0]):
-        stat = os.statvfs(path)
-        for args in grouped_combinations:
-            results_dict[args] = get_stat(stat, args[1])
-
+    table = get_mount_table()
+    item_paths = list(set(args[0] for args in combinations))
+    real_paths = dict(zip(item_paths, get_all([get_watchdog(paths, path, 'realpath', resolve, path_ttl) for path in item_paths])))
+    mount_points = list(set(table.find(real_path) for real_path in real_paths.itervalues() if real_path is not None))
+    stats = dict(zip(mount_points, get_all([get_watchdog(mounts, mount_point, 'statvfs', os.statvfs, mount_ttl) for mount_point in mount_points])))
     results = []
     for args in combinations:
-        results.append(results_dict[args])
+        path, mode = args[:2]
+        real_path = real_paths[path]
+        stat = real_path is not None and stats[table.find(real_path)] or None
+        try:
+            results.append(stat is None and 'ZBX_NOTSUPPORTED' or get_stat(stat, mode))
+        except KeyError:
+            logging.getLogger('zabbix-agent-ng').warning('invalid mode {0}: must be one of total, avail, free, itotal, iavail or ifree'.format(mode))
+            results.append('ZBX_NOTSUPPORTED')
     return results
 
 if __name__ == '__main__':
-    import sys
-    res1 = main(sys.argv[1], sys.argv[2])
-    res2 = vmain([(sys.argv[1], sys.argv[2])])
-    print res1, res2
+    print(main(sys.argv[1], sys.argv[2]))
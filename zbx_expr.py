@@ -0,0 +1,79 @@
+'''
+Arithmetic expressions over collector counters, e.g.
+'Tcp.ActiveOpens - prev.Tcp.ActiveOpens' or 'total - free'.
+
+Expressions are parsed once, checked against a whitelist of syntax nodes
+(arithmetic, comparisons, conditional expressions, attribute access and
+calls of a few numeric functions) and cached as code objects, so
+evaluation is a single eval of precompiled code without builtins.
+Power is not allowed: 9**9**9 would pin a CPU already when compiled.
+The cache is bounded: when it fills up, the least recently used half of
+it is dropped.
+'''
+
+import ast
+import threading
+import itertools
+
+class ExpressionError(Exception):
+    pass
+
+functions = {'min': min, 'max': max, 'abs': abs, 'int': int, 'float': float, 'round': round}
+
+allowed_nodes = (
+    ast.Expression, ast.Num, ast.Name, ast.Load, ast.Attribute,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.UnaryOp, ast.UAdd, ast.USub, ast.Not,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.IfExp, ast.Call,
+)
+
+cache_size = 1000
+
+# expression -> [code, time of last use]
+_cache = {}
+_cache_lock = threading.Lock()
+_clock = itertools.count()
+
+def validate(tree):
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed_nodes):
+            raise ExpressionError('{0} is not allowed'.format(type(node).__name__))
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise ExpressionError('private attribute {0} is not allowed'.format(node.attr))
+        if isinstance(node, ast.Name) and node.id.startswith('_'):
+            raise ExpressionError('private name {0} is not allowed'.format(node.id))
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in functions:
+                raise ExpressionError('only {0} can be called'.format(', '.join(sorted(functions))))
+            if node.keywords or node.starargs or node.kwargs:
+                raise ExpressionError('only positional arguments are allowed')
+
+def compile_expression(expr):
+    '''returns cached code object for expr; raises ExpressionError for invalid expressions'''
+    entry = _cache.get(expr)
+    if entry is not None:
+        entry[1] = next(_clock)
+        return entry[0]
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError, e:
+        raise ExpressionError('invalid expression {0!r}: {1}'.format(expr, e))
+    validate(tree)
+    code = compile(tree, '<expression>', 'eval')
+    with _cache_lock:
+        if len(_cache) >= cache_size:
+            # evicting in bulk keeps hits down to stamping the time of use
+            for key, entry in sorted(_cache.iteritems(), key=lambda item: item[1][1])[:len(_cache) - cache_size / 2]:
+                del _cache[key]
+        _cache[expr] = [code, next(_clock)]
+    return code
+
+def evaluate(expr, names):
+    return eval(compile_expression(expr), {'__builtins__': functions}, names)
+
+class Namespace(object):
+    '''attribute access to a dict, e.g. prev.Tcp'''
+    def __init__(self, names):
+        self.__dict__.update(names)
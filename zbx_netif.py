@@ -1,36 +1,100 @@
 #!/usr/bin/python
 
+import logging
+import threading
+import zbx_procfs
+
 fields = {
     'rx':
     {
-        'bytes': 1,
-        'packets': 2,
+        'bytes': 0,
+        'packets': 1,
+        'errs': 2,
+        'drop': 3,
+        'fifo': 4,
+        'frame': 5,
+        'compressed': 6,
+        'multicast': 7,
     },
     'tx':
     {
-        'bytes': 9,
-        'packets': 10,
+        'bytes': 8,
+        'packets': 9,
+        'errs': 10,
+        'drop': 11,
+        'fifo': 12,
+        'colls': 13,
+        'carrier': 14,
+        'compressed': 15,
     },
 }
 
-def get_stat(lines, iface, dir, units):
-    for line in lines:
-        if line.strip().startswith(iface):
-            return line.split()[fields[dir][units]]
+modes = ('', 'delta', 'rate')
+
+# last two (value, timestamp) samples for delta and rate modes, by item arguments (iface, dir, units, mode),
+# so items of one counter don't advance each other's samples; a passive check of the same key shares them.
+# They advance only on a newer snapshot, so all readers of one snapshot get the same delta.
+samples = {}
+samples_lock = threading.Lock()
+
+def parse_dev(data):
+    ifaces = {}
+    for line in data.splitlines()[2:]:
+        iface, counters = line.split(':', 1)
+        ifaces[iface.strip()] = map(int, counters.split())
+    return ifaces
+
+def get_delta(value, prev_value):
+    if value >= prev_value:
+        return value - prev_value
+    if prev_value < 2**32:
+        # 32-bit counter wrapped
+        return value + 2**32 - prev_value
+    # 64-bit counters don't wrap in practice: interface was recreated
+    return None
+
+def get_stat(ifaces, timestamp, iface, dir, units, mode=''):
+    if mode not in modes:
+        raise ValueError('invalid mode {0}: must be one of <empty string>, delta or rate'.format(mode))
+    counters = ifaces.get(iface)
+    if counters is None:
+        return None
+    value = counters[fields[dir][units]]
+    if mode == '':
+        return value
+    key = (iface, dir, units, mode)
+    with samples_lock:
+        prev, last = samples.get(key, (None, None))
+        if last is None or last[1] < timestamp:
+            prev, last = samples[key] = (last, (value, timestamp))
+        elif last[1] > timestamp:
+            # caller holds an older snapshot than the last sample
+            return None
+    if prev is None:
+        return None
+    delta = get_delta(last[0], prev[0])
+    if delta is None or mode == 'delta':
+        return delta
+    return delta / (last[1] - prev[1])
 
-def main(iface, dir, units):
-    return get_stat(open('/proc/net/dev').readlines(), iface, dir, units)
+def main(iface, dir, units, mode=''):
+    return vmain([(iface, dir, units, mode)])[0]
 
 def vmain(combinations):
+    snapshot = zbx_procfs.snapshot('net/dev')
+    ifaces = zbx_procfs.parse_snapshot(snapshot, parse_dev)
     results = []
-    lines = open('/proc/net/dev').readlines()
     for args in combinations:
-        results.append(get_stat(lines, *args))
+        try:
+            results.append(get_stat(ifaces, snapshot.timestamp, *args))
+        except (KeyError, ValueError, TypeError), e:
+            logging.getLogger('zabbix-agent-ng').warning('invalid net.if arguments {0}: {1!r}'.format(args, e))
+            results.append('ZBX_NOTSUPPORTED')
     return results
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 4:
-        print('Usage: {0} <iface> <rx|tx> <bytes|packets>'.format(sys.argv[0]))
+    if len(sys.argv) not in (4, 5):
+        print('Usage: {0} <iface> <rx|tx> <bytes|packets|errs|drop|fifo|frame|colls|carrier|compressed|multicast> [delta|rate]'.format(sys.argv[0]))
         sys.exit(1)
-    print(main(sys.argv[1], sys.argv[2], sys.argv[3]))
+    print(main(*sys.argv[1:]))
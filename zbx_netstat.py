@@ -1,45 +1,63 @@
 #!/usr/bin/python
 
-from itertools import izip, chain
+from itertools import izip
 from collections import namedtuple
 import logging
+import threading
+import zbx_procfs
+import zbx_expr
 
-def get_stat():
-    lines_snmp = open('/proc/net/snmp').readlines()
-    lines_netstat = open('/proc/net/netstat').readlines()
-    args = [chain(lines_snmp, lines_netstat)] * 2
+# counter record types by group name and field names, built once
+record_types = {}
+
+def parse_groups(data):
+    args = [iter(data.splitlines())] * 2
     groups = {}
     for names, values in izip(*args):
         group1, namelist = names.split(':')
         group2, valuelist = values.split(':')
         assert(group1 == group2)
-        group_type = namedtuple(group1, namelist.split())
+        names = tuple(namelist.split())
+        group_type = record_types.get((group1, names))
+        if group_type is None:
+            group_type = record_types[(group1, names)] = namedtuple(group1, names)
         groups[group1] = group_type(*map(int, valuelist.split()))
     return groups
 
+def read_stat():
+    groups = {}
+    groups.update(zbx_procfs.parse('net/snmp', parse_groups))
+    groups.update(zbx_procfs.parse('net/netstat', parse_groups))
+    return groups
+
+def get_stat():
+    # same object for all callers while snapshot is fresh
+    return zbx_procfs.cached('netstat', read_stat)
+
 def main(expr):
-    return vmain([expr])[0]
+    return vmain([(expr,)])[0]
 
+# stat of the latest and of the previous snapshot; 'prev' moves only when a new snapshot is read
+current_stat = None
 prev_stat = None
+stat_lock = threading.Lock()
 
 def vmain(combinations):
+    global current_stat, prev_stat
     stat = get_stat()
-    stat_tuple_type = namedtuple('Stat', stat.keys())
-    stat_tuple = stat_tuple_type(*stat.values())
-    global prev_stat
-    if prev_stat is None:
-        prev_stat = stat_tuple
+    with stat_lock:
+        if stat is not current_stat:
+            prev_stat = current_stat or stat
+            current_stat = stat
+        names = dict(stat, prev=zbx_expr.Namespace(prev_stat))
     results = []
     for expr in combinations:
         try:
-            locals_ = stat
-            locals_.update({'prev': prev_stat})
-            result = eval(expr[0], {}, locals_)
+            result = zbx_expr.evaluate(expr[0], names)
         except Exception, e:
-            logging.getLogger('zabbix-agent-ng').warning('failed to evaluate expression {0} with locals={1}: {2}'.format(expr, stat, e))
+            logging.getLogger('zabbix-agent-ng').warning('failed to evaluate expression {0}: {1}'.format(expr[0], e))
             result = None
         results.append(result)
-    prev_stat = stat_tuple
     return results
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+'''
+Per-tick snapshots of /proc files shared by collector modules.
+
+Each file is read at most once per `ttl` seconds into a reusable buffer;
+parsed representations are built lazily on first use and cached together
+with the snapshot they were built from, so all items checked in one tick
+share a single read and a single parse.
+'''
+
+import io
+import threading
+import time
+
+root = '/proc'
+ttl = 0.5
+
+_lock = threading.Lock()
+_snapshots = {}
+_buffers = {}
+_cache = {}
+
+class Snapshot(object):
+    def __init__(self, data, timestamp):
+        self.data = data
+        self.timestamp = timestamp
+        self.parsed = {}
+
+def _read(name):
+    buf = _buffers.get(name)
+    if buf is None:
+        buf = _buffers[name] = bytearray(4096)
+    size = 0
+    f = io.open('{0}/{1}'.format(root, name), 'rb', buffering=0)
+    try:
+        while True:
+            if size == len(buf):
+                buf.extend(bytearray(len(buf)))
+            n = f.readinto(memoryview(buf)[size:])
+            if not n:
+                break
+            size += n
+    finally:
+        f.close()
+    return str(buf[:size])
+
+def snapshot(name):
+    '''returns snapshot of /proc/<name> not older than ttl'''
+    now = time.time()
+    with _lock:
+        s = _snapshots.get(name)
+        if s is None or s.timestamp + ttl <= now:
+            s = _snapshots[name] = Snapshot(_read(name), now)
+        return s
+
+def read(name):
+    return snapshot(name).data
+
+def parse_snapshot(s, parser):
+    try:
+        return s.parsed[parser]
+    except KeyError:
+        result = s.parsed[parser] = parser(s.data)
+        return result
+
+def parse(name, parser):
+    '''returns parser(contents of /proc/<name>), parsed once per snapshot'''
+    return parse_snapshot(snapshot(name), parser)
+
+def _splitlines(data):
+    return data.splitlines()
+
+def lines(name):
+    return parse(name, _splitlines)
+
+def cached(name, builder):
+    '''returns builder() result, rebuilt at most once per ttl; for data not backed by one file'''
+    now = time.time()
+    with _lock:
+        entry = _cache.get(name)
+        if entry is not None and entry[0] + ttl > now:
+            return entry[1]
+    result = builder()
+    with _lock:
+        _cache[name] = (now, result)
+    return result
@@ -1,34 +1,157 @@
+import os
 import sys
-import psutil
-import itertools
+import pwd
+import logging
+import threading
+import zbx_procfs
 
 class ZbxMemException(Exception):
     pass
 
-def filterproc(name, user, cmdline):
-    return itertools.ifilter(
-        lambda proc: (name == '' or proc.name == name) and
-                     (user == '' or proc.username == user) and
-                     (cmdline == '' or (proc.cmdline and proc.cmdline[0] == cmdline)),
-        psutil.process_iter())
+page_size = os.sysconf('SC_PAGE_SIZE')
 
-def main(memtype, name, user, mode, cmdline):
-    rsss = list(itertools.imap(lambda proc: proc.get_memory_info()[{'rss':0,'vms':1}[memtype]], filterproc(name, user, cmdline)))
-    if len(rsss) == 0:
+class Process(object):
+    __slots__ = ('pid', 'name', 'uid', 'rss', 'vms', 'smaps')
+
+    def __init__(self, pid, name, uid, rss, vms):
+        self.pid = pid
+        self.name = name
+        self.uid = uid
+        self.rss = rss
+        self.vms = vms
+        self.smaps = None
+
+    def path(self, name):
+        return '{0}/{1}/{2}'.format(zbx_procfs.root, self.pid, name)
+
+    def read_smaps(self):
+        '''returns (pss, uss) in bytes'''
+        if self.smaps is None:
+            pss = uss = 0
+            try:
+                try:
+                    f = open(self.path('smaps_rollup'))
+                except IOError:
+                    f = open(self.path('smaps'))
+                for line in f:
+                    if line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+                    elif line.startswith('Private_'):
+                        uss += int(line.split()[1])
+                f.close()
+            except IOError:
+                pass
+            self.smaps = (pss * 1024, uss * 1024)
+        return self.smaps
+
+    def get_memory(self, memtype):
+        if memtype == 'rss':
+            return self.rss
+        elif memtype == 'vms':
+            return self.vms
+        elif memtype == 'pss':
+            return self.read_smaps()[0]
+        elif memtype == 'uss':
+            return self.read_smaps()[1]
+        raise ZbxMemException('invalid memory type: must be one of rss, vms, pss, uss or count')
+
+class ProcessTable(object):
+    '''
+    All processes read in one /proc scan, indexed by name and owner.
+    Index by argv[0] is built on first use, as it needs reading every cmdline.
+    '''
+    def __init__(self):
+        self.by_name = {}
+        self.by_uid = {}
+        self.cmdline_index = None
+        self.lock = threading.Lock()
+        self.processes = []
+        for entry in os.listdir(zbx_procfs.root):
+            if not entry.isdigit():
+                continue
+            try:
+                path = '{0}/{1}'.format(zbx_procfs.root, entry)
+                uid = os.stat(path).st_uid
+                stat = open(path + '/stat').read()
+            except (IOError, OSError):
+                # process exited
+                continue
+            name_end = stat.rindex(')')
+            fields = stat[name_end+2:].split()
+            proc = Process(entry, stat[stat.index('(')+1:name_end], uid, int(fields[21]) * page_size, int(fields[20]))
+            self.processes.append(proc)
+            self.by_name.setdefault(proc.name, []).append(proc)
+            self.by_uid.setdefault(proc.uid, []).append(proc)
+
+    def by_cmdline(self):
+        with self.lock:
+            if self.cmdline_index is None:
+                index = {}
+                for proc in self.processes:
+                    try:
+                        argv0 = open(proc.path('cmdline')).read().split('\0', 1)[0]
+                    except IOError:
+                        continue
+                    index.setdefault(argv0, []).append(proc)
+                self.cmdline_index = index
+            return self.cmdline_index
+
+    def select(self, name, user, cmdline):
+        candidates = [self.processes]
+        if name != '':
+            candidates.append(self.by_name.get(name, []))
+        if user != '':
+            candidates.append(self.by_uid.get(get_uid(user), []))
+        if cmdline != '':
+            candidates.append(self.by_cmdline().get(cmdline, []))
+        selected = min(candidates, key=len)
+        if len(candidates) > 2:
+            pids = reduce(set.intersection, [set(p.pid for p in c) for c in candidates[1:]])
+            selected = [p for p in selected if p.pid in pids]
+        return selected
+
+def get_uid(user):
+    try:
+        return pwd.getpwnam(user).pw_uid
+    except KeyError:
+        return None
+
+def aggregate(values, mode):
+    if len(values) == 0:
         return 0
     if mode == 'sum' or mode == '':
-        return sum(rsss)
+        return sum(values)
     elif mode == 'avg':
-        return sum(rsss) / len(rsss)
+        return sum(values) / len(values)
     elif mode == 'min':
-        return min(rsss)
+        return min(values)
     elif mode == 'max':
-        return max(rsss)
+        return max(values)
     else:
         raise ZbxMemException('invalid mode: must be one of [<empty string> or sum,avg,min,max]')
 
+def get_stat(table, memtype, name, user, mode, cmdline):
+    processes = table.select(name, user, cmdline)
+    if memtype == 'count':
+        return len(processes)
+    return aggregate([proc.get_memory(memtype) for proc in processes], mode)
+
+def main(memtype, name, user, mode, cmdline):
+    return get_stat(zbx_procfs.cached('processes', ProcessTable), memtype, name, user, mode, cmdline)
+
+def vmain(combinations):
+    table = zbx_procfs.cached('processes', ProcessTable)
+    results = []
+    for args in combinations:
+        try:
+            results.append(get_stat(table, *args))
+        except ZbxMemException, e:
+            logging.getLogger('zabbix-agent-ng').warning('invalid proc.mem arguments {0}: {1}'.format(args, e))
+            results.append('ZBX_NOTSUPPORTED')
+    return results
+
 if __name__ == '__main__':
     if len(sys.argv) < 6:
-        print('usage: {0} rss|vms <name> <user> <mode>(""|sum|avg|min|max) <cmdline>'.format(sys.argv[0]))
+        print('usage: {0} rss|vms|pss|uss|count <name> <user> <mode>(""|sum|avg|min|max) <cmdline>'.format(sys.argv[0]))
         sys.exit(1)
     print(main(*sys.argv[1:6]))
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
+import zbx_procfs
+
 def main():
-    return int(open("/proc/net/stat/rt_cache").readlines()[1].split(" ")[0], 16)
+    return int(zbx_procfs.lines('net/stat/rt_cache')[1].split(" ")[0], 16)
 
 if __name__ == '__main__':
     print(main())
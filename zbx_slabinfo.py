@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import zbx_procfs
+
+def parse_slabinfo(data):
+    '''slab name -> fields of its /proc/slabinfo line (name is field 1)'''
+    slabs = {}
+    for line in data.splitlines()[2:]:
+        fields = line.split()
+        if fields:
+            slabs[fields[0]] = fields
+    return slabs
+
+def get_stat(slabs, name, column):
+    fields = slabs.get(name)
+    if fields is None:
+        # substring match, as grep of the shell collector did
+        for slab in sorted(slabs):
+            if name in slab:
+                fields = slabs[slab]
+                break
+        else:
+            return 'ZBX_NOTSUPPORTED'
+    column = int(column)
+    if not 1 <= column <= len(fields):
+        return 'ZBX_NOTSUPPORTED'
+    return fields[column - 1]
+
+def main(name, column):
+    return vmain([(name, column)])[0]
+
+def vmain(combinations):
+    slabs = zbx_procfs.parse('slabinfo', parse_slabinfo)
+    results = []
+    for args in combinations:
+        try:
+            results.append(get_stat(slabs, *args[:2]))
+        except ValueError, e:
+            logging.getLogger('zabbix-agent-ng').warning('invalid sys.slabinfo arguments {0}: {1}'.format(args, e))
+            results.append('ZBX_NOTSUPPORTED')
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: {0} <slab name> <column>'.format(sys.argv[0]))
+        sys.exit(1)
+    print(main(sys.argv[1], sys.argv[2]))
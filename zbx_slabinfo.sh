@@ -1,3 +1,36 @@
 #!/bin/bash
 
+# zabbix-agent-ng coprocess worker: reads /proc/slabinfo once per batch of "<name>\t<column>" records
+slabinfo_worker() {
+    local count line name column i fields
+    local -A slabs
+    while read -r count; do
+        slabs=()
+        if [ "$count" -gt 0 ]; then
+            while read -r line; do
+                slabs[${line%% *}]=$line
+            done < /proc/slabinfo
+        fi
+        echo "$count"
+        for ((i = 0; i < count; i++)); do
+            IFS=$'\t' read -r name column
+            # fields are reset for every record: an empty or unknown name must not reuse the previous slab
+            fields=()
+            if [ -n "$name" ]; then
+                fields=(${slabs[$name]})
+            fi
+            if [[ $column =~ ^[1-9][0-9]*$ ]] && [ -n "${fields[$((column - 1))]}" ]; then
+                echo "${fields[$((column - 1))]}"
+            else
+                echo ZBX_NOTSUPPORTED
+            fi
+        done
+    done
+}
+
+if [ "$1" = "--worker" ]; then
+    slabinfo_worker
+    exit 0
+fi
+
 cat /proc/slabinfo | grep "$1" | awk '{ print $'$2' }'
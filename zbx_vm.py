@@ -1,15 +1,38 @@
 import sys
-import psutil
+import logging
+import zbx_procfs
+import zbx_expr
+
+# expression names and /proc/meminfo fields they are read from
+fields = {
+    'free': 'SwapFree',
+    'available': 'SwapFree',
+    'pfree': 'MemFree',
+    'buffers': 'Buffers',
+    'total': 'SwapTotal',
+    'cached': 'Cached',
+}
+
+def parse_meminfo(data):
+    meminfo = {}
+    for line in data.splitlines():
+        name, value = line.split(':', 1)
+        meminfo[name] = int(value.split()[0]) * 1024
+    return dict((var, meminfo.get(field, 0)) for var, field in fields.iteritems())
 
 def main(expr):
-    vars = {'free': psutil.avail_virtmem(),
-            'available': psutil.avail_virtmem(),
-            'pfree': psutil.avail_phymem(),
-            'buffers': psutil.phymem_buffers(),
-            'total': psutil.total_virtmem(),
-            'cached': psutil.cached_phymem(),
-    }
-    return eval(expr, {}, vars)
+    return vmain([(expr,)])[0]
+
+def vmain(combinations):
+    vars = zbx_procfs.parse('meminfo', parse_meminfo)
+    results = []
+    for args in combinations:
+        try:
+            results.append(zbx_expr.evaluate(args[0], vars))
+        except Exception, e:
+            logging.getLogger('zabbix-agent-ng').warning('failed to evaluate expression {0}: {1}'.format(args[0], e))
+            results.append('ZBX_NOTSUPPORTED')
+    return results
 
 if __name__ == '__main__':
     if len(sys.argv) < 2: